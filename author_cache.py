@@ -0,0 +1,54 @@
+"""Shared, batched lookups of author karma.
+
+Authors are resolved in bulk through Reddit's user_data_by_account_ids endpoint
+(PRAW's redditors.partial_redditors), up to 100 accounts per request, and the
+results are kept in the author_cache table so every worker shares them.
+"""
+import time
+
+BATCH_SIZE = 100
+
+
+def store_karma(conn, rows):
+    """Upserts (username, fullname, link_karma, comment_karma) rows into author_cache."""
+    now = time.time()
+    c = conn.cursor()
+    c.executemany('''INSERT INTO author_cache (username, fullname, link_karma, comment_karma, fetched_at)
+                 VALUES (%s, %s, %s, %s, %s)
+                 ON CONFLICT (username) DO UPDATE SET fullname = COALESCE(EXCLUDED.fullname, author_cache.fullname),
+                     link_karma = EXCLUDED.link_karma, comment_karma = EXCLUDED.comment_karma, fetched_at = EXCLUDED.fetched_at''',
+                  [(username.lower(), fullname, link_karma, comment_karma, now)
+                   for username, fullname, link_karma, comment_karma in rows])
+    conn.commit()
+
+
+def lookup_karma(reddit, conn, authors, ttl=3600):
+    """Returns {lowercase username: total karma} for the given {username: account fullname}.
+
+    Cached values younger than ttl are used as-is; the rest are fetched in batches of 100.
+    Authors Reddit doesn't return (suspended or deleted accounts) are left out.
+    """
+    if not authors:
+        return {}
+    wanted = {name.lower(): fullname for name, fullname in authors.items()}
+
+    c = conn.cursor()
+    c.execute("SELECT username, link_karma + comment_karma FROM author_cache WHERE username = ANY(%s) AND fetched_at > %s",
+              (list(wanted), time.time() - ttl))
+    karma = dict(c.fetchall())
+    conn.commit()
+
+    missing = [fullname for name, fullname in wanted.items() if name not in karma and fullname]
+    for i in range(0, len(missing), BATCH_SIZE):
+        try:
+            partials = list(reddit.redditors.partial_redditors(missing[i:i + BATCH_SIZE]))
+        except Exception as e:
+            print(f"Batch author lookup failed: {e}")
+            continue
+        rows = []
+        for partial in partials:
+            name = partial.name.lower()
+            karma[name] = partial.link_karma + partial.comment_karma
+            rows.append((name, wanted.get(name), partial.link_karma, partial.comment_karma))
+        store_karma(conn, rows)
+    return karma
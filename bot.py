@@ -1,11 +1,18 @@
 import praw
 import time
 import psycopg2
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 from dotenv import load_dotenv
 import re
 import yaml
+import select
+import threading
+import socket
+from near_duplicates import NearDuplicateIndex
+from rate_budget import RateBudget, BudgetedRequestor, ENFORCEMENT, BACKGROUND
+from author_cache import lookup_karma
+import modmail_sync
 
 # Load environment variables
 load_dotenv()
@@ -19,6 +26,68 @@ REDDIT_PASSWORD = os.getenv('REDDIT_PASSWORD')
 TEST_MODE = os.getenv('TEST_MODE', 'false').lower() == 'true'
 
 SUBREDDIT_NAME = os.getenv('SUBREDDIT_NAME', 'SydneyTrains')
+# Several subreddits can share one stream, e.g. "SydneyTrains+SydneyBuses"
+SUBREDDIT_NAMES = [name.strip() for name in re.split(r'[+,]', SUBREDDIT_NAME) if name.strip()]
+
+# How long (seconds) a subreddit's moderator list is cached before refetching
+MOD_CACHE_TTL = int(os.getenv('MOD_CACHE_TTL', '600'))
+# How long (seconds) an author's karma is cached in author_cache before refetching
+KARMA_CACHE_TTL = int(os.getenv('KARMA_CACHE_TTL', '3600'))
+
+# Scaling: "stream" only reads the subreddit stream (when elected leader),
+# "worker" only processes queued submissions and comments, "all" does both.
+BOT_ROLE = os.getenv('BOT_ROLE', 'all').lower()
+WORKER_ID = os.getenv('WORKER_ID', f"{socket.gethostname()}:{os.getpid()}")
+JOB_BATCH_SIZE = int(os.getenv('JOB_BATCH_SIZE', '100')) # reddit.info fetches up to 100 items per call
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '5'))
+# Longest wait (seconds) between stream polls while nothing new arrives, matching PRAW's own stream backoff
+STREAM_MAX_BACKOFF = 16
+# A worker that claims a partial batch waits this long (seconds) for more jobs,
+# so posts arriving close together share one submission fetch and one author lookup
+JOB_BATCH_WINDOW = float(os.getenv('JOB_BATCH_WINDOW', '1'))
+JOB_STALE_AFTER = int(os.getenv('JOB_STALE_AFTER', '300'))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Finished jobs are kept this long (seconds); older stream items are never queued, since nothing
+# would remember they were already handled
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', '259200')) # 3 days
+JOB_CHANNEL = 'submission_jobs'
+
+# Also moderate comments (queued alongside submissions; comment jobs are keyed by fullname, e.g. t1_abc123)
+MODERATE_COMMENTS = os.getenv('MODERATE_COMMENTS', 'true').lower() == 'true'
+
+# Modmail mirror: how often (seconds) a stream-role replica syncs modmail into Postgres
+# (0 disables syncing), and how many conversations the first sync backfills
+MODMAIL_SYNC_INTERVAL = int(os.getenv('MODMAIL_SYNC_INTERVAL', '60'))
+MODMAIL_BACKFILL = int(os.getenv('MODMAIL_BACKFILL', '200'))
+# How often (seconds) the whole unarchived listing is walked to catch conversations archived on Reddit
+MODMAIL_RECONCILE_INTERVAL = int(os.getenv('MODMAIL_RECONCILE_INTERVAL', '3600'))
+
+# Rule ordering: rules run highest `priority` first; within a priority, they're re-sorted every
+# RULE_REORDER_EVERY checks so cheap, frequently matching rules run before slow, rarely matching ones.
+RULE_REORDER_EVERY = int(os.getenv('RULE_REORDER_EVERY', '500'))
+RULE_STATS_MIN_CHECKS = 100
+
+# Near-duplicate detection: how far back (seconds) and how many posts the index covers
+NEAR_DUPLICATE_WINDOW = int(os.getenv('NEAR_DUPLICATE_WINDOW', '604800')) # 7 days
+NEAR_DUPLICATE_MAX_POSTS = int(os.getenv('NEAR_DUPLICATE_MAX_POSTS', '20000'))
+
+# Partitioning: posts are split by day and mod_actions by month. Posts older than
+# POST_RETENTION are removed by dropping whole partitions.
+POST_RETENTION = 86400 # 24 hours in seconds
+PARTITIONS_AHEAD = int(os.getenv('PARTITIONS_AHEAD', '3'))
+# mod_actions months older than this are archived (0 keeps everything in the live table).
+# "detach" keeps them as standalone mod_actions_archive_* tables; "drop" deletes them.
+MOD_ACTIONS_RETENTION_MONTHS = int(os.getenv('MOD_ACTIONS_RETENTION_MONTHS', '0'))
+MOD_ACTIONS_ARCHIVE_MODE = os.getenv('MOD_ACTIONS_ARCHIVE_MODE', 'detach').lower()
+PARTITIONED_TABLES = {
+    'posts': 'day',
+    'mod_actions': 'month'
+}
+
+# Advisory lock keys (arbitrary, but must be unique within the database)
+SCHEMA_LOCK_ID = 7351001
+STREAM_LOCK_ID = 7351002
+MODMAIL_LOCK_ID = 7351003
 
 # Database Configuration
 DB_HOST = os.getenv('DB_HOST', 'db')
@@ -26,20 +95,63 @@ DB_NAME = os.getenv('DB_NAME', 'sydneytrains')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'password')
 
+# Config is stored as versioned rows in Postgres. The web editor publishes
+# new versions on this channel and the bot swaps them in without restarting.
+CONFIG_CHANNEL = 'config_changed'
+CONFIG_FILES = {
+    'automod': 'automod.yaml',
+    'tiers': 'tiers.yaml'
+}
+DEFAULT_TIERS = [{'max_karma': 250, 'limit': 1}, {'max_karma': 500, 'limit': 2}, {'max_karma': float('inf'), 'limit': 4}]
+
 # Moderators are automatically exempt from these limits.
 
 # =================================================
 
-def init_db():
-    conn = psycopg2.connect(
+# Active config, replaced as a whole whenever a new version is loaded.
+# Keyed by lowercase subreddit name; '' holds the shared default.
+active_config = {'subreddits': {'': {'rules': [], 'tiers': DEFAULT_TIERS, 'near_duplicates': False}}, 'versions': {}}
+
+# Content checks since the rule sets were last re-sorted
+rule_checks = 0
+
+# subreddit -> (fetched_at, set of lowercase moderator names)
+moderator_cache = {}
+
+# Recent post signatures for "(near-duplicate)" triggers, rebuilt from post_signatures on startup
+near_duplicate_index = NearDuplicateIndex(max_age=NEAR_DUPLICATE_WINDOW, max_items=NEAR_DUPLICATE_MAX_POSTS)
+last_signature_id = 0
+
+def get_db_connection():
+    return psycopg2.connect(
         host=DB_HOST,
         database=DB_NAME,
         user=DB_USER,
         password=DB_PASSWORD
     )
+
+# Reddit request budget shared with the web app (same credentials, same rate limit)
+reddit_budget = RateBudget(get_db_connection)
+
+def get_reddit(priority=ENFORCEMENT):
+    # PRAW isn't thread-safe, so each thread that talks to Reddit gets its own instance
+    return praw.Reddit(
+        client_id=REDDIT_CLIENT_ID,
+        client_secret=REDDIT_CLIENT_SECRET,
+        user_agent=REDDIT_USER_AGENT,
+        username=REDDIT_USERNAME,
+        password=REDDIT_PASSWORD,
+        requestor_class=BudgetedRequestor,
+        requestor_kwargs={'budget': reddit_budget, 'priority': priority}
+    )
+
+def init_db():
+    conn = get_db_connection()
     c = conn.cursor()
+    # Serialize migrations when several replicas start at once
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
     c.execute('''CREATE TABLE IF NOT EXISTS posts
-                 (username TEXT, timestamp DOUBLE PRECISION)''')
+                 (username TEXT, timestamp DOUBLE PRECISION, subreddit TEXT)''')
     # Create table for moderation logs
     c.execute('''CREATE TABLE IF NOT EXISTS mod_actions
                  (id SERIAL PRIMARY KEY, 
@@ -55,52 +167,497 @@ def init_db():
     if not c.fetchone():
         c.execute("ALTER TABLE mod_actions ADD COLUMN can_approve BOOLEAN DEFAULT TRUE")
     
+    # Migration: Add subreddit columns for multi-subreddit mode, backfilling existing rows
+    # with the first configured subreddit
+    default_sub = SUBREDDIT_NAMES[0].lower()
+    for table in ('posts', 'mod_actions'):
+        c.execute("SELECT column_name FROM information_schema.columns WHERE table_name=%s AND column_name='subreddit'", (table,))
+        if not c.fetchone():
+            c.execute(f"ALTER TABLE {table} ADD COLUMN subreddit TEXT")
+            c.execute(f"UPDATE {table} SET subreddit = %s WHERE subreddit IS NULL", (default_sub,))
+
+    # Migration: Track which submission a counted post came from so retried jobs don't count twice
+    c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='posts' AND column_name='submission_id'")
+    if not c.fetchone():
+        c.execute("ALTER TABLE posts ADD COLUMN submission_id TEXT")
+
+    # Migration: Indexed log search. search_vector is maintained by Postgres from the
+    # username, action type and details; trigram indexes back substring (ILIKE) matches.
+    c.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='mod_actions' AND column_name='search_vector'")
+    if not c.fetchone():
+        c.execute('''ALTER TABLE mod_actions ADD COLUMN search_vector tsvector GENERATED ALWAYS AS
+                     (to_tsvector('simple', coalesce(username, '') || ' ' || coalesce(action_type, '') || ' ' || coalesce(details, ''))) STORED''')
+
+    # Migration: Partition posts and mod_actions by time. Indexes are created afterwards
+    # so they're defined on the partitioned tables (and cascade to every partition).
+    for table, period in PARTITIONED_TABLES.items():
+        partition_table(c, table, period)
+    create_partitions(c)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_posts_subreddit_user ON posts (subreddit, username, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_posts_submission ON posts (submission_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mod_actions_subreddit_time ON mod_actions (subreddit, timestamp DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mod_actions_submission ON mod_actions (submission_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mod_actions_search ON mod_actions USING GIN (search_vector)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mod_actions_username_trgm ON mod_actions USING GIN (username gin_trgm_ops)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mod_actions_type_trgm ON mod_actions USING GIN (action_type gin_trgm_ops)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mod_actions_details_trgm ON mod_actions USING GIN (details gin_trgm_ops)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_mod_actions_time ON mod_actions (timestamp DESC)")
+
+    # Create queue of submissions (and comments) waiting for a worker (one row per item)
+    c.execute('''CREATE TABLE IF NOT EXISTS submission_jobs
+                 (submission_id TEXT PRIMARY KEY, subreddit TEXT, status TEXT NOT NULL DEFAULT 'pending',
+                  enqueued_at DOUBLE PRECISION, claimed_at DOUBLE PRECISION, completed_at DOUBLE PRECISION,
+                  worker TEXT, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_submission_jobs_status ON submission_jobs (status, enqueued_at)")
+
+    # Create table of MinHash signatures for near-duplicate detection (shared by all replicas)
+    c.execute('''CREATE TABLE IF NOT EXISTS post_signatures
+                 (id SERIAL PRIMARY KEY, submission_id TEXT UNIQUE, subreddit TEXT, username TEXT,
+                  timestamp DOUBLE PRECISION, signature BIGINT[])''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_post_signatures_time ON post_signatures (timestamp)")
+
+    # Create table caching author karma from batched lookups (shared by all workers)
+    c.execute('''CREATE TABLE IF NOT EXISTS author_cache
+                 (username TEXT PRIMARY KEY, fullname TEXT, link_karma INTEGER, comment_karma INTEGER,
+                  fetched_at DOUBLE PRECISION)''')
+
+    # Create modmail mirror tables (synced by run_modmail_sync, read by the web app)
+    modmail_sync.create_tables(c)
+
     # Create table for user notes
     c.execute('''CREATE TABLE IF NOT EXISTS user_notes
                  (username TEXT PRIMARY KEY, note TEXT, timestamp DOUBLE PRECISION, moderator TEXT)''')
 
-    conn.commit()
+    # Per-user moderation summary, kept current by triggers on mod_actions and user_notes.
+    # Each user has a row per subreddit plus a '' row covering all subreddits (which also holds the note).
+    c.execute("SELECT to_regclass('user_summary')")
+    summary_exists = c.fetchone()[0] is not None
+    c.execute('''CREATE TABLE IF NOT EXISTS user_summary
+                 (username_key TEXT NOT NULL, subreddit TEXT NOT NULL DEFAULT '', username TEXT,
+                  action_counts JSONB NOT NULL DEFAULT '{}', total_actions INTEGER NOT NULL DEFAULT 0,
+                  first_seen DOUBLE PRECISION, last_seen DOUBLE PRECISION,
+                  note TEXT, note_moderator TEXT, note_timestamp DOUBLE PRECISION,
+                  PRIMARY KEY (username_key, subreddit))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_user_summary_total ON user_summary (subreddit, total_actions DESC)")
+    if not summary_exists:
+        print("Building user_summary from existing mod_actions and user_notes...")
+        rebuild_user_summary(c)
+
+    c.execute('''CREATE OR REPLACE FUNCTION user_summary_log_action() RETURNS trigger AS $$
+                 BEGIN
+                     IF NEW.username IS NULL OR NEW.action_type IS NULL THEN
+                         RETURN NULL;
+                     END IF;
+                     INSERT INTO user_summary AS s (username_key, subreddit, username, action_counts, total_actions, first_seen, last_seen)
+                     SELECT DISTINCT lower(NEW.username), sub, NEW.username, jsonb_build_object(NEW.action_type, 1), 1, NEW.timestamp, NEW.timestamp
+                     FROM unnest(ARRAY['', COALESCE(NEW.subreddit, '')]) AS sub
+                     ON CONFLICT (username_key, subreddit) DO UPDATE SET
+                         username = EXCLUDED.username,
+                         action_counts = s.action_counts || jsonb_build_object(NEW.action_type, COALESCE((s.action_counts->>NEW.action_type)::int, 0) + 1),
+                         total_actions = s.total_actions + 1,
+                         first_seen = LEAST(s.first_seen, EXCLUDED.first_seen),
+                         last_seen = GREATEST(s.last_seen, EXCLUDED.last_seen);
+                     RETURN NULL;
+                 END;
+                 $$ LANGUAGE plpgsql''')
+    c.execute('''CREATE OR REPLACE TRIGGER trg_user_summary_actions AFTER INSERT ON mod_actions
+                 FOR EACH ROW EXECUTE FUNCTION user_summary_log_action()''')
+    c.execute('''CREATE OR REPLACE FUNCTION user_summary_note() RETURNS trigger AS $$
+                 BEGIN
+                     IF TG_OP = 'DELETE' THEN
+                         UPDATE user_summary SET note = NULL, note_moderator = NULL, note_timestamp = NULL
+                         WHERE username_key = lower(OLD.username) AND subreddit = '';
+                         RETURN NULL;
+                     END IF;
+                     INSERT INTO user_summary (username_key, subreddit, username, note, note_moderator, note_timestamp)
+                     VALUES (lower(NEW.username), '', NEW.username, NEW.note, NEW.moderator, NEW.timestamp)
+                     ON CONFLICT (username_key, subreddit) DO UPDATE SET note = EXCLUDED.note,
+                         note_moderator = EXCLUDED.note_moderator, note_timestamp = EXCLUDED.note_timestamp;
+                     RETURN NULL;
+                 END;
+                 $$ LANGUAGE plpgsql''')
+    c.execute('''CREATE OR REPLACE TRIGGER trg_user_summary_notes AFTER INSERT OR UPDATE OR DELETE ON user_notes
+                 FOR EACH ROW EXECUTE FUNCTION user_summary_note()''')
+
+    # Web page cache. data_version goes up with every statement that writes to mod_actions or
+    # user_notes, in the same transaction, so cached results are valid while it stays put.
+    c.execute("CREATE TABLE IF NOT EXISTS data_version (id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id), version BIGINT NOT NULL)")
+    c.execute("INSERT INTO data_version (version) VALUES (1) ON CONFLICT DO NOTHING")
+    c.execute('''CREATE UNLOGGED TABLE IF NOT EXISTS page_cache
+                 (key TEXT PRIMARY KEY, version BIGINT NOT NULL, result JSONB, created_at DOUBLE PRECISION)''')
+    c.execute('''CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+                 BEGIN
+                     UPDATE data_version SET version = version + 1;
+                     RETURN NULL;
+                 END;
+                 $$ LANGUAGE plpgsql''')
+    for table in ('mod_actions', 'user_notes'):
+        c.execute(f'''CREATE OR REPLACE TRIGGER trg_{table}_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+                      FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version()''')
+
+    # Create table for versioned config (automod rules and karma tiers)
+    c.execute('''CREATE TABLE IF NOT EXISTS config_versions
+                 (id SERIAL PRIMARY KEY, name TEXT NOT NULL, content TEXT NOT NULL,
+                  timestamp DOUBLE PRECISION, moderator TEXT, restored_from INTEGER)''')
+
+    # Migration: Per-subreddit config overrides ('' is the shared default)
+    c.execute("SELECT column_name FROM information_schema.columns WHERE table_name='config_versions' AND column_name='subreddit'")
+    if not c.fetchone():
+        c.execute("ALTER TABLE config_versions ADD COLUMN subreddit TEXT NOT NULL DEFAULT ''")
+    c.execute("DROP INDEX IF EXISTS idx_config_versions_name")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_config_versions_name_sub ON config_versions (name, subreddit, id DESC)")
+
+    # seed_config commits, releasing the schema lock
+    seed_config(conn)
     return conn
 
-def clean_old_posts(conn):
-    """Removes entries older than 24 hours"""
+def rebuild_user_summary(c):
+    """Recomputes user_summary from mod_actions and user_notes (first start, or after a bulk load with triggers off)."""
+    c.execute("TRUNCATE user_summary")
+    c.execute('''WITH per_type AS (
+                     SELECT lower(username) AS username_key, s.sub AS subreddit, action_type, MAX(username) AS username,
+                            COUNT(*) AS n, MIN(timestamp) AS first_seen, MAX(timestamp) AS last_seen
+                     FROM mod_actions
+                     CROSS JOIN LATERAL (SELECT DISTINCT unnest(ARRAY['', COALESCE(subreddit, '')]) AS sub) s
+                     WHERE username IS NOT NULL AND action_type IS NOT NULL
+                     GROUP BY 1, 2, 3)
+                 INSERT INTO user_summary (username_key, subreddit, username, action_counts, total_actions, first_seen, last_seen)
+                 SELECT username_key, subreddit, MAX(username), jsonb_object_agg(action_type, n), SUM(n), MIN(first_seen), MAX(last_seen)
+                 FROM per_type GROUP BY 1, 2''')
+    c.execute('''INSERT INTO user_summary (username_key, subreddit, username, note, note_moderator, note_timestamp)
+                 SELECT lower(username), '', username, note, moderator, timestamp FROM user_notes
+                 ON CONFLICT (username_key, subreddit) DO UPDATE SET note = EXCLUDED.note,
+                     note_moderator = EXCLUDED.note_moderator, note_timestamp = EXCLUDED.note_timestamp''')
+
+def period_start(period, dt):
+    if period == 'day':
+        return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def next_period(period, dt):
+    if period == 'day':
+        return dt + timedelta(days=1)
+    return dt.replace(year=dt.year + dt.month // 12, month=dt.month % 12 + 1)
+
+def partition_name(table, period, start):
+    return f"{table}_p{start:%Y_%m_%d}" if period == 'day' else f"{table}_p{start:%Y_%m}"
+
+def list_partitions(c, table, period):
+    """Returns [(name, start, end)] for the table's time partitions (excluding the default one)."""
+    c.execute('''SELECT child.relname FROM pg_inherits
+                 JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                 JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                 WHERE parent.relname = %s''', (table,))
+    partitions = []
+    for (name,) in c.fetchall():
+        match = re.fullmatch(rf"{table}_p(\d{{4}})_(\d{{2}})(?:_(\d{{2}}))?", name)
+        if not match:
+            continue
+        start = datetime(int(match.group(1)), int(match.group(2)), int(match.group(3) or 1), tzinfo=timezone.utc)
+        partitions.append((name, start, next_period(period, start)))
+    return partitions
+
+def create_partition(c, table, period, start):
+    """Creates one partition. Must run under the schema lock (callers hold it for the transaction)."""
+    end = next_period(period, start)
+    name = partition_name(table, period, start)
+    bounds = (start.timestamp(), end.timestamp())
+    # Creating a partition fails if stray rows for its range already sit in the default partition
+    c.execute(f"SELECT 1 FROM {table}_default WHERE timestamp >= %s AND timestamp < %s LIMIT 1", bounds)
+    if not c.fetchone():
+        c.execute(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)", bounds)
+        return
+
+    # Move them into a standalone table and attach it, so the rows end up where they can be
+    # dropped or archived. Inserting into the standalone table doesn't fire the parent's triggers.
+    print(f"Moving stray rows from {table}_default into {name}")
+    c.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING GENERATED)")
+    c.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s AND is_generated = 'NEVER' ORDER BY ordinal_position", (table,))
+    columns = ', '.join(row[0] for row in c.fetchall())
+    c.execute(f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {table}_default WHERE timestamp >= %s AND timestamp < %s", bounds)
+    c.execute(f"DELETE FROM {table}_default WHERE timestamp >= %s AND timestamp < %s", bounds)
+    c.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", bounds)
+
+def create_partitions(c, since=None):
+    """Creates partitions from the current period (or `since`) through PARTITIONS_AHEAD periods ahead."""
+    now = datetime.now(timezone.utc)
+    for table, period in PARTITIONED_TABLES.items():
+        start = period_start(period, since or now)
+        last = period_start(period, now)
+        for _ in range(PARTITIONS_AHEAD):
+            last = next_period(period, last)
+        while start <= last:
+            create_partition(c, table, period, start)
+            start = next_period(period, start)
+
+def partition_table(c, table, period):
+    """One-off conversion of a plain table into one range-partitioned on timestamp."""
+    c.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relnamespace = 'public'::regnamespace", (table,))
+    if c.fetchone()[0] != 'r':
+        return
+    print(f"Partitioning {table} by {period}...")
+    legacy = f"{table}_legacy"
+    c.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+    c.execute(f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING GENERATED) PARTITION BY RANGE (timestamp)")
+    c.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+    # Keep the id sequence alive when the legacy table (its owner) is dropped. posts has no id
+    # column, and pg_get_serial_sequence raises rather than returning NULL for a missing column.
+    sequence = None
+    c.execute("SELECT 1 FROM information_schema.columns WHERE table_name = %s AND column_name = 'id'", (legacy,))
+    if c.fetchone():
+        c.execute("SELECT pg_get_serial_sequence(%s, 'id')", (legacy,))
+        sequence = c.fetchone()[0]
+    if sequence:
+        c.execute(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+        c.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, timestamp)")
+
+    # Expired posts aren't worth carrying over
+    where = f"WHERE timestamp >= {time.time() - POST_RETENTION}" if table == 'posts' else ''
+    c.execute(f"SELECT min(timestamp) FROM {legacy} {where}")
+    oldest = c.fetchone()[0]
+    if oldest is not None:
+        for name, p in PARTITIONED_TABLES.items():
+            if name == table:
+                start = period_start(p, datetime.fromtimestamp(oldest, timezone.utc))
+                while start <= datetime.now(timezone.utc):
+                    create_partition(c, table, p, start)
+                    start = next_period(p, start)
+
+    c.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s AND is_generated = 'NEVER' ORDER BY ordinal_position", (legacy,))
+    columns = ', '.join(row[0] for row in c.fetchall())
+    select_columns = columns.replace('timestamp', 'COALESCE(timestamp, 0)') if sequence else columns
+    c.execute(f"INSERT INTO {table} ({columns}) SELECT {select_columns} FROM {legacy} {where}")
+    c.execute(f"DROP TABLE {legacy}")
+    if sequence:
+        c.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+
+def maintain_partitions(conn):
+    """Creates upcoming partitions, drops expired post partitions and archives old mod_actions months."""
+    c = conn.cursor()
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+    create_partitions(c)
+
+    now = datetime.now(timezone.utc)
+    for name, start, end in list_partitions(c, 'posts', 'day'):
+        if end.timestamp() <= now.timestamp() - POST_RETENTION:
+            c.execute(f"DROP TABLE {name}")
+
+    if MOD_ACTIONS_RETENTION_MONTHS > 0:
+        cutoff = period_start('month', now)
+        for _ in range(MOD_ACTIONS_RETENTION_MONTHS):
+            cutoff = (cutoff - timedelta(days=1)).replace(day=1)
+        for name, start, end in list_partitions(c, 'mod_actions', 'month'):
+            if end > cutoff:
+                continue
+            if MOD_ACTIONS_ARCHIVE_MODE == 'drop':
+                c.execute(f"DROP TABLE {name}")
+            else:
+                c.execute(f"ALTER TABLE mod_actions DETACH PARTITION {name}")
+                c.execute(f"ALTER TABLE {name} RENAME TO {name.replace('mod_actions_p', 'mod_actions_archive_')}")
+            print(f"Archived {name} ({MOD_ACTIONS_ARCHIVE_MODE})")
+            # Archived rows disappear from the log, so cached web pages are stale
+            c.execute("UPDATE data_version SET version = version + 1")
+    conn.commit()
+
+def seed_config(conn):
+    """Imports the local YAML files as the default version of any config not yet stored in the DB."""
     c = conn.cursor()
-    cutoff = time.time() - 86400 # 24 hours in seconds
-    c.execute("DELETE FROM posts WHERE timestamp < %s", (cutoff,))
+    for name, path in CONFIG_FILES.items():
+        c.execute("SELECT 1 FROM config_versions WHERE name = %s AND subreddit = '' LIMIT 1", (name,))
+        if c.fetchone():
+            continue
+        try:
+            with open(path, 'r') as f:
+                content = f.read()
+        except FileNotFoundError:
+            continue
+        c.execute("INSERT INTO config_versions (name, content, timestamp, moderator) VALUES (%s, %s, %s, %s)",
+                  (name, content, time.time(), 'seed'))
+        print(f"Seeded {name} config from {path}")
     conn.commit()
 
-def get_user_post_count(conn, username):
+def rule_order_key(compiled):
+    """Higher priority first; within a priority, lowest expected cost per match first (file order breaks ties)."""
+    stats = compiled['stats']
+    if stats['checks'] < RULE_STATS_MIN_CHECKS:
+        # Not measured yet; keep it early so it gets measured
+        return (-compiled['priority'], 0, compiled['index'])
+    avg_cost = stats['cost'] / stats['checks']
+    hit_rate = (stats['hits'] + 1) / (stats['checks'] + 2)
+    return (-compiled['priority'], avg_cost / hit_rate, compiled['index'])
+
+def reorder_rules():
+    """Re-sorts every active rule set using the cost and hit statistics gathered so far."""
+    seen = set()
+    for sub, sub_config in active_config['subreddits'].items():
+        rules = sub_config['rules']
+        if id(rules) in seen:
+            continue
+        seen.add(id(rules))
+        before = [compiled['rule'].get('name') for compiled in rules]
+        rules.sort(key=rule_order_key)
+        after = [compiled['rule'].get('name') for compiled in rules]
+        if after != before:
+            print(f"Rule order for /r/{sub or 'default'}: {', '.join(after)}")
+
+def compile_rules(rules):
+    """Parses trigger keys and precompiles patterns so each post only runs the matching."""
+    compiled = []
+    for index, rule in enumerate(rules or []):
+        triggers = []
+        for key, patterns in rule.get('triggers', {}).items():
+            # Normalize patterns to list
+            if not isinstance(patterns, list):
+                patterns = [patterns]
+
+            # Determine target field and mode
+            mode = 'contains' # default
+            if '(regex)' in key:
+                mode = 'regex'
+                key = key.replace(' (regex)', '')
+            elif '(starts-with)' in key:
+                mode = 'startswith'
+                key = key.replace(' (starts-with)', '')
+            elif '(near-duplicate)' in key:
+                # Value is the similarity threshold (0-1); always compares title+body
+                mode = 'near-duplicate'
+                key = key.replace(' (near-duplicate)', '')
+
+            matchers = []
+            for pattern in patterns:
+                if mode == 'near-duplicate':
+                    matchers.append((pattern, float(pattern)))
+                    continue
+                if mode != 'regex':
+                    matchers.append((pattern, str(pattern).lower()))
+                    continue
+                try:
+                    matchers.append((pattern, re.compile(pattern, re.IGNORECASE)))
+                except re.error as e:
+                    print(f"Skipping invalid regex in rule {rule.get('name')}: {pattern!r} ({e})")
+
+            # Handle combined keys like "title+body"
+            triggers.append({
+                'fields': [field.strip() for field in key.split('+')],
+                'mode': mode,
+                'patterns': matchers
+            })
+        compiled.append({
+            'rule': rule,
+            'triggers': triggers,
+            'priority': rule.get('priority', 0),
+            'index': index,
+            'stats': {'checks': 0, 'hits': 0, 'cost': 0.0}
+        })
+    compiled.sort(key=rule_order_key)
+    return compiled
+
+def load_config(conn):
+    """Loads the latest config versions and atomically swaps in the compiled rule sets."""
+    global active_config
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT DISTINCT ON (name, subreddit) name, subreddit, id, content
+                     FROM config_versions ORDER BY name, subreddit, id DESC''')
+        rows = c.fetchall()
+        conn.commit()
+
+        versions = {(name, sub): version_id for name, sub, version_id, _ in rows}
+        if versions == active_config['versions']:
+            return
+
+        # Parse and compile each version once, even if several subreddits share it
+        contents = {(name, sub): (version_id, content) for name, sub, version_id, content in rows}
+        parsed = {}
+        def resolve(name, sub):
+            version_id, content = contents.get((name, sub)) or contents.get((name, ''), (None, None))
+            if version_id is None:
+                return None
+            if version_id not in parsed:
+                data = yaml.safe_load(content)
+                parsed[version_id] = compile_rules(data) if name == 'automod' else (data or DEFAULT_TIERS)
+            return parsed[version_id]
+
+        subreddits = {}
+        for sub in [''] + [name.lower() for name in SUBREDDIT_NAMES]:
+            rules = resolve('automod', sub) or []
+            subreddits[sub] = {
+                'rules': rules,
+                'tiers': resolve('tiers', sub) or DEFAULT_TIERS,
+                'near_duplicates': any(t['mode'] == 'near-duplicate' for r in rules for t in r['triggers'])
+            }
+        active_config = {'subreddits': subreddits, 'versions': versions}
+        print(f"Loaded config versions: {versions}")
+    except Exception as e:
+        conn.rollback()
+        print(f"Error loading config: {e}. Keeping current config.")
+
+def listen_for_config_changes():
+    """Reloads config whenever the web editor publishes a new version."""
+    while True:
+        try:
+            conn = get_db_connection()
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f"LISTEN {CONFIG_CHANNEL}")
+            # Catch up on anything published while we weren't listening
+            load_config(conn)
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    conn.notifies.clear()
+                    load_config(conn)
+        except Exception as e:
+            print(f"Config listener error: {e}. Reconnecting in 5s...")
+            time.sleep(5)
+
+def get_sub_config(sub_name):
+    """Returns the active rules and tiers for a subreddit, falling back to the default."""
+    subreddits = active_config['subreddits']
+    return subreddits.get(sub_name) or subreddits['']
+
+def get_moderators(reddit, sub_name):
+    """Returns the lowercase moderator names for a subreddit, refreshed every MOD_CACHE_TTL seconds."""
+    cached = moderator_cache.get(sub_name)
+    if cached and time.time() - cached[0] < MOD_CACHE_TTL:
+        return cached[1]
+    mods = {mod.name.lower() for mod in reddit.subreddit(sub_name).moderator()}
+    moderator_cache[sub_name] = (time.time(), mods)
+    return mods
+
+def get_user_post_count(conn, username, sub_name):
     c = conn.cursor()
-    c.execute("SELECT count(*) FROM posts WHERE username = %s", (username,))
+    # Expired partitions are dropped hourly, so filter the window here too
+    cutoff = time.time() - POST_RETENTION
+    c.execute("SELECT count(*) FROM posts WHERE subreddit = %s AND username = %s AND timestamp >= %s", (sub_name, username, cutoff))
     return c.fetchone()[0]
 
-def log_post(conn, username):
+def log_post(conn, username, sub_name, submission_id=None):
     c = conn.cursor()
-    c.execute("INSERT INTO posts VALUES (%s, %s)", (username, time.time()))
+    c.execute("INSERT INTO posts (username, timestamp, subreddit, submission_id) VALUES (%s, %s, %s, %s)",
+              (username, time.time(), sub_name, submission_id))
     conn.commit()
 
-def log_mod_action(conn, action_type, username, details, submission_id=None, can_approve=True):
+def is_already_handled(conn, submission_id):
+    """True if a previous attempt already counted or actioned this submission."""
+    c = conn.cursor()
+    c.execute('''SELECT 1 FROM posts WHERE submission_id = %s
+                 UNION ALL SELECT 1 FROM mod_actions WHERE submission_id = %s LIMIT 1''', (submission_id, submission_id))
+    return c.fetchone() is not None
+
+def log_mod_action(conn, action_type, username, details, submission_id=None, can_approve=True, subreddit=None):
     try:
         c = conn.cursor()
-        c.execute("INSERT INTO mod_actions (action_type, username, details, timestamp, submission_id, can_approve) VALUES (%s, %s, %s, %s, %s, %s)",
-                  (action_type, username, details, time.time(), submission_id, can_approve))
+        c.execute("INSERT INTO mod_actions (action_type, username, details, timestamp, submission_id, can_approve, subreddit) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                  (action_type, username, details, time.time(), submission_id, can_approve, subreddit))
         conn.commit()
     except Exception as e:
         print(f"Failed to log action: {e}")
 
-def get_tiers():
-    default_tiers = [{'max_karma': 250, 'limit': 1}, {'max_karma': 500, 'limit': 2}, {'max_karma': float('inf'), 'limit': 4}]
-    try:
-        with open('tiers.yaml', 'r') as f:
-            tiers = yaml.safe_load(f)
-            if not tiers: return default_tiers
-            return tiers
-    except Exception as e:
-        print(f"Error loading tiers.yaml: {e}. Using defaults.")
-        return default_tiers
-
-def get_limit_for_user(karma):
-    tiers = get_tiers()
+def get_limit_for_user(karma, tiers):
     for tier in tiers:
         max_karma = tier.get('max_karma', 0)
         limit = tier.get('limit', 1)
@@ -108,73 +665,133 @@ def get_limit_for_user(karma):
             return limit
     return 4
 
-def check_content_rules(conn, submission, subreddit):
-    """Checks submission against automod rules. Returns True if removed."""
-    
-    # Load rules
-    try:
-        with open('automod.yaml', 'r') as f:
-            rules = yaml.safe_load(f)
-    except Exception as e:
-        print(f"Error loading automod.yaml: {e}")
-        return False
+def sync_signatures(conn):
+    """Adds signatures recorded since the last sync (by any replica) to the local index."""
+    global last_signature_id
+    c = conn.cursor()
+    c.execute('''SELECT id, submission_id, username, timestamp, signature FROM post_signatures
+                 WHERE id > %s AND timestamp > %s ORDER BY id''', (last_signature_id, time.time() - NEAR_DUPLICATE_WINDOW))
+    for row_id, submission_id, username, timestamp, signature in c.fetchall():
+        near_duplicate_index.add(submission_id, username, timestamp, signature)
+        last_signature_id = row_id
+    conn.commit()
 
-    # Prepare content for checking
-    content_map = {
-        'title': submission.title,
-        'body': submission.selftext,
-        'domain': submission.domain,
-        'combined': f"{submission.title} {submission.selftext}"
+def record_signature(conn, submission, sub_name, signature):
+    c = conn.cursor()
+    c.execute('''INSERT INTO post_signatures (submission_id, subreddit, username, timestamp, signature)
+                 VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING''',
+              (submission.id, sub_name, str(submission.author), time.time(), list(signature)))
+    conn.commit()
+    near_duplicate_index.add(submission.id, str(submission.author), time.time(), signature)
+
+def clean_old_signatures(conn):
+    """Removes signatures that have aged out of the near-duplicate window"""
+    c = conn.cursor()
+    c.execute("DELETE FROM post_signatures WHERE timestamp < %s", (time.time() - NEAR_DUPLICATE_WINDOW,))
+    conn.commit()
+
+LINK_PATTERN = re.compile(r'https?://[^\s)\]>"\']+', re.IGNORECASE)
+LINK_DOMAIN_PATTERN = re.compile(r'^https?://(?:[^/?#@]*@)?(?:www\.)?([^/:?#@]+)', re.IGNORECASE)
+
+def normalize_content(item, kind):
+    """Prepares an item once for every rule: raw values for regexes, lowercase values for the other
+    modes, plus the URLs and domains it links to. Each field maps to a list of values."""
+    if kind == 'comment':
+        title, body = '', item.body or ''
+        combined = body
+        domains, urls = [], []
+    else:
+        title, body = item.title or '', item.selftext or ''
+        combined = f"{title} {body}"
+        domains = [item.domain.lower()] if item.domain else []
+        urls = [] if item.is_self else [item.url]
+
+    for url in LINK_PATTERN.findall(f"{title}\n{body}"):
+        urls.append(url)
+        domain = LINK_DOMAIN_PATTERN.match(url)
+        if not domain:
+            continue
+        # Domain triggers compare whole domains, so drop a trailing root dot ('bit.ly.')
+        domain = domain.group(1).lower().rstrip('.')
+        if domain and domain not in domains:
+            domains.append(domain)
+
+    raw = {
+        'title': [title] if title else [],
+        'body': [body] if body else [],
+        'domain': domains,
+        'url': urls,
+        'combined': [combined] if combined.strip() else []
+    }
+    return {
+        'raw': raw,
+        'lower': {field: [value.lower() for value in values] for field, values in raw.items()}
     }
 
-    for rule in rules:
-        matched = False
-        match_val = ""
-        
-        # Check triggers
-        triggers = rule.get('triggers', {})
-        for key, patterns in triggers.items():
-            # Normalize patterns to list
-            if not isinstance(patterns, list):
-                patterns = [patterns]
+def match_rule(compiled, content, signature, author):
+    """Returns the matched pattern (or near-duplicate description) if any trigger matches, else None."""
+    for trigger in compiled['triggers']:
+        mode = trigger['mode']
 
-            # Determine target field and mode
-            target_fields = []
-            mode = 'contains' # default
-            
-            if '(regex)' in key:
-                mode = 'regex'
-                key = key.replace(' (regex)', '')
-            elif '(starts-with)' in key:
-                mode = 'startswith'
-                key = key.replace(' (starts-with)', '')
-            
-            # Handle combined keys like "title+body"
-            keys = key.split('+')
-            
-            # Check patterns against fields
-            for field in keys:
-                text_to_check = content_map.get(field.strip(), '')
-                if not text_to_check: continue
+        if mode == 'near-duplicate':
+            for pattern, threshold in trigger['patterns']:
+                duplicate = near_duplicate_index.query(signature, threshold, exclude_author=author)
+                if duplicate:
+                    return f"{duplicate[2]:.0%} similar to {duplicate[0]} by u/{duplicate[1]}"
+            continue
 
-                for pattern in patterns:
+        # Regexes carry their own case handling (some use (?-i:...)), the rest compare lowercase
+        values = content['raw' if mode == 'regex' else 'lower']
+        for field in trigger['fields']:
+            for text in values.get(field, ()):
+                for pattern, matcher in trigger['patterns']:
                     if mode == 'regex':
-                        if re.search(pattern, text_to_check, re.IGNORECASE):
-                            matched = True
-                            match_val = pattern
-                            break
+                        if matcher.search(text):
+                            return pattern
                     elif mode == 'startswith':
-                        if text_to_check.lower().startswith(pattern.lower()):
-                            matched = True
-                            match_val = pattern
-                            break
-                    else: # contains/exact match for domains
-                        if pattern.lower() in text_to_check.lower():
-                            matched = True
-                            match_val = pattern
-                            break
-                if matched: break
-            if matched: break
+                        if text.startswith(matcher):
+                            return pattern
+                    elif field == 'domain':
+                        # Whole domains or their subdomains only, so 't.co' doesn't match 'reddit.com'
+                        if text == matcher or text.endswith('.' + matcher):
+                            return pattern
+                    elif matcher in text:
+                        return pattern
+    return None
+
+def check_content_rules(conn, submission, sub_name, kind='submission'):
+    """Checks a submission (or comment) against automod rules. Returns True if removed."""
+    global rule_checks
+
+    # Prepare content for checking
+    content = normalize_content(submission, kind)
+
+    sub_config = get_sub_config(sub_name)
+    signature = None
+    # Near-duplicate matching only covers submissions; comments would flood the index
+    if sub_config['near_duplicates'] and kind == 'submission':
+        sync_signatures(conn)
+        signature = near_duplicate_index.signature(content['raw']['combined'][0] if content['raw']['combined'] else '')
+        # Queries skip the author's own posts, so recording first doesn't self-match
+        if signature is not None:
+            record_signature(conn, submission, sub_name, signature)
+
+    rule_checks += 1
+    if rule_checks >= RULE_REORDER_EVERY:
+        rule_checks = 0
+        reorder_rules()
+
+    author = str(submission.author)
+    for compiled in sub_config['rules']:
+        rule = compiled['rule']
+        stats = compiled['stats']
+        started = time.perf_counter()
+        match_val = match_rule(compiled, content, signature, author)
+        stats['cost'] += time.perf_counter() - started
+        stats['checks'] += 1
+        matched = match_val is not None
+        if matched:
+            stats['hits'] += 1
         
         if matched:
             print(f"Triggered Rule: {rule['name']} on {submission.id}")
@@ -190,11 +807,12 @@ def check_content_rules(conn, submission, subreddit):
 
             # Send Notifications
             if 'message' in rule:
-                msg = rule['message'].replace('{{kind}}', 'submission').replace('{{match}}', str(match_val))
+                msg = rule['message'].replace('{{kind}}', kind).replace('{{match}}', str(match_val))
                 if TEST_MODE:
                     print(f"[TEST MODE] Would reply to {submission.id}: {msg.splitlines()[0]}...")
                 else:
-                    submission.reply(msg).mod.distinguish(sticky=True)
+                    # Only top-level replies to a submission can be stickied
+                    submission.reply(msg).mod.distinguish(sticky=(kind == 'submission'))
             
             # Log Action
             can_approve = rule.get('allow_approval', True)
@@ -202,100 +820,362 @@ def check_content_rules(conn, submission, subreddit):
             action_type = f"RULE_{rule['name'].upper().replace(' ', '_')}"
             if TEST_MODE:
                 action_type = f"TEST_{action_type}"
-            log_mod_action(conn, action_type, str(submission.author), details, submission.id, can_approve)
+            # Comments are logged by fullname so the web app can tell them apart from submission ids
+            item_id = submission.fullname if kind == 'comment' else submission.id
+            log_mod_action(conn, action_type, str(submission.author), details, item_id, can_approve, sub_name)
             return True
 
     return False
 
-def main():
-    # Check for missing credentials
-    if not all([REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET, REDDIT_USERNAME, REDDIT_PASSWORD]):
-        print("Error: Missing Reddit credentials. Please check your .env file.")
+def job_key(item):
+    """Submissions are queued by id, comments by fullname (t1_...), so the two can't collide."""
+    return item.fullname if isinstance(item, praw.models.Comment) else item.id
+
+def job_fullname(job_id):
+    return job_id if job_id.startswith('t1_') else f"t3_{job_id}"
+
+def enqueue_items(conn, items):
+    """Queues submissions/comments for the workers in one transaction. Re-enqueueing the same id is a no-op."""
+    c = conn.cursor()
+    queued = 0
+    now = time.time()
+    for item in items:
+        # A failover replays the recent listing. Jobs (and posts) for items this old may already
+        # be purged, so they'd be checked and counted a second time.
+        if item.created_utc < now - JOB_RETENTION:
+            continue
+        c.execute("INSERT INTO submission_jobs (submission_id, subreddit, enqueued_at) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+                  (job_key(item), item.subreddit.display_name.lower(), now))
+        queued += c.rowcount
+    if queued:
+        c.execute("SELECT pg_notify(%s, %s)", (JOB_CHANNEL, str(queued)))
+    conn.commit()
+
+def clean_old_jobs(conn):
+    """Removes finished jobs once they're too old to show up in a stream replay (enqueue_items skips older items)"""
+    c = conn.cursor()
+    cutoff = time.time() - JOB_RETENTION
+    c.execute("DELETE FROM submission_jobs WHERE status IN ('done', 'failed') AND enqueued_at < %s", (cutoff,))
+    conn.commit()
+
+def claim_jobs(conn, limit=JOB_BATCH_SIZE):
+    """Claims a batch of pending (or abandoned) jobs for this worker."""
+    c = conn.cursor()
+    now = time.time()
+    c.execute('''UPDATE submission_jobs SET status = 'processing', claimed_at = %s, worker = %s, attempts = attempts + 1
+                 WHERE submission_id IN (
+                     SELECT submission_id FROM submission_jobs
+                     WHERE (status = 'pending' OR (status = 'processing' AND claimed_at < %s)) AND attempts < %s
+                     ORDER BY enqueued_at LIMIT %s
+                     FOR UPDATE SKIP LOCKED)
+                 RETURNING submission_id''', (now, WORKER_ID, now - JOB_STALE_AFTER, JOB_MAX_ATTEMPTS, limit))
+    job_ids = [row[0] for row in c.fetchall()]
+    conn.commit()
+    return job_ids
+
+def finish_jobs(conn, job_ids):
+    """Marks a batch of jobs done in one statement."""
+    if not job_ids:
         return
+    c = conn.cursor()
+    c.execute("UPDATE submission_jobs SET status = 'done', completed_at = %s, error = NULL WHERE submission_id = ANY(%s)",
+              (time.time(), list(job_ids)))
+    conn.commit()
 
-    reddit = praw.Reddit(
-        client_id=REDDIT_CLIENT_ID,
-        client_secret=REDDIT_CLIENT_SECRET,
-        user_agent=REDDIT_USER_AGENT,
-        username=REDDIT_USERNAME,
-        password=REDDIT_PASSWORD
-    )
+def finish_job(conn, submission_id, error=None):
+    c = conn.cursor()
+    if error is None:
+        c.execute("UPDATE submission_jobs SET status = 'done', completed_at = %s, error = NULL WHERE submission_id = %s",
+                  (time.time(), submission_id))
+    else:
+        # Leave it pending for another attempt until it runs out of retries
+        c.execute('''UPDATE submission_jobs SET status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'pending' END, error = %s
+                     WHERE submission_id = %s''', (JOB_MAX_ATTEMPTS, error, submission_id))
+    conn.commit()
+
+def get_author_karma(author, karma_cache=None):
+    """Returns the author's global karma, from the batched lookup if available."""
+    name = author.name.lower()
+    if karma_cache and name in karma_cache:
+        return karma_cache[name]
+    # Not in the batch (e.g. no account id in the listing), so fetch it on its own
+    author._fetch()
+    return author.link_karma + author.comment_karma
+
+def process_comment(reddit, conn, comment):
+    """Applies content rules to a single comment. Posting limits only apply to submissions."""
+    author = comment.author
+    if not author:
+        return
+
+    sub_name = comment.subreddit.display_name.lower()
+    # Same cached moderator list as submissions
+    if author.name.lower() in get_moderators(reddit, sub_name):
+        return
+    if is_already_handled(conn, comment.fullname):
+        return
+
+    check_content_rules(conn, comment, sub_name, kind='comment')
+
+def process_submission(reddit, conn, submission, karma_cache=None):
+    """Applies content rules and posting limits to a single submission."""
+    author = submission.author
     
-    subreddit = reddit.subreddit(SUBREDDIT_NAME)
-    conn = init_db()
+    # If author is deleted/missing, skip
+    if not author:
+        return
+        
+    sub_name = submission.subreddit.display_name.lower()
+
+    # Ignore mods
+    if author.name.lower() in get_moderators(reddit, sub_name):
+        return
+
+    # A retried job may have been part-way done before its worker died
+    if is_already_handled(conn, submission.id):
+        return
+
+    # 0. Check Content Rules (Spam, Links, Profanity)
+    if check_content_rules(conn, submission, sub_name):
+        return
+
+    # 1. Check Karma (Total Global Karma)
+    # Note: Reddit API doesn't give easy access to subreddit-specific karma
+    # without heavy processing, so this uses Global Karma (Link + Comment).
+    try:
+        total_karma = get_author_karma(author, karma_cache)
+    except Exception as e:
+        print(f"Could not fetch karma for {author}: {e}")
+        total_karma = 0
+
+    # 2. Determine Limit
+    limit = get_limit_for_user(total_karma, get_sub_config(sub_name)['tiers'])
     
-    print(f"Listening for new posts in /r/{SUBREDDIT_NAME}...")
-    if TEST_MODE:
-        print("!!! RUNNING IN TEST MODE - No actions will be taken on Reddit !!!")
+    # 3. Check how many posts they made in last 24h
+    current_count = get_user_post_count(conn, author.name, sub_name)
 
-    # skip_existing=True prevents it from checking old posts when you first start it
-    for submission in subreddit.stream.submissions(skip_existing=True):
-        try:
-            author = submission.author
+    print(f"New post in r/{sub_name} by {author.name} (Karma: {total_karma}). Count: {current_count}. Limit: {limit}")
+
+    if current_count >= limit:
+        print(f" -> REMOVING post by {author.name}")
+        
+        if TEST_MODE:
+            print(f"[TEST MODE] Would remove post {submission.id} by {author.name}")
+            print(f"[TEST MODE] Would reply to {author.name}")
+        else:
+            # Remove the post
+            submission.mod.remove(mod_note="Daily post limit exceeded")
             
-            # If author is deleted/missing, skip
-            if not author:
-                continue
-                
-            # Ignore mods
-            if submission.author in subreddit.moderator():
-                continue
+            # Reply to user
+            reply_text = (
+                f"Hi /u/{author.name}, your post has been removed because you have reached your daily posting limit.\n\n"
+                f"Your account has **{total_karma} karma**, which limits you to **{limit} post(s)** per 24 hours.\n\n"
+                "Please try again tomorrow!"
+            )
+            submission.reply(reply_text).mod.distinguish(sticky=True)
+        
+        details = f"Karma: {total_karma}, Limit: {limit}"
+        action_type = "REMOVE_LIMIT"
+        if TEST_MODE:
+            action_type = f"TEST_{action_type}"
+        log_mod_action(conn, action_type, author.name, details, submission.id, subreddit=sub_name)
+    else:
+        # Log the valid post
+        log_post(conn, author.name, sub_name, submission.id)
 
-            # 0. Check Content Rules (Spam, Links, Profanity)
-            if check_content_rules(conn, submission, subreddit):
+def run_stream_leader():
+    """Competes for the stream lock; the holder reads the combined streams and enqueues submissions and comments."""
+    while True:
+        conn = None
+        try:
+            conn = get_db_connection()
+            c = conn.cursor()
+            c.execute("SELECT pg_try_advisory_lock(%s)", (STREAM_LOCK_ID,))
+            if not c.fetchone()[0]:
+                # Another replica is the leader; the lock frees up if its connection drops
+                conn.close()
+                time.sleep(JOB_POLL_INTERVAL)
                 continue
+            conn.commit()
 
-            # 1. Clean DB of old posts
-            clean_old_posts(conn)
+            # With no job history this is a fresh install, so don't process old posts.
+            # Otherwise replay the recent listing so posts seen during a failover aren't missed;
+            # items that were already queued are ignored by enqueue_items.
+            c.execute("SELECT 1 FROM submission_jobs LIMIT 1")
+            skip_existing = c.fetchone() is None
+            conn.commit()
 
-            # 2. Check Karma (Total Global Karma)
-            # Note: Reddit API doesn't give easy access to subreddit-specific karma
-            # without heavy processing, so this uses Global Karma (Link + Comment).
-            try:
-                # Force fetch user data
-                author._fetch() 
-                total_karma = author.link_karma + author.comment_karma
-            except Exception as e:
-                print(f"Could not fetch karma for {author}: {e}")
-                total_karma = 0
+            reddit = get_reddit()
+            print(f"[{WORKER_ID}] Elected stream leader. Listening for new posts{' and comments' if MODERATE_COMMENTS else ''} in /r/{'+'.join(SUBREDDIT_NAMES)}...")
+            subreddit = reddit.subreddit('+'.join(SUBREDDIT_NAMES))
+            # pause_after=0 yields None as soon as a stream has nothing new, which lets one thread
+            # alternate between the streams (and still run housekeeping on quiet days)
+            # Each stream backs off on its own, so a busy comment stream doesn't keep a quiet
+            # submission stream polled back to back (or the other way round)
+            streams = [{'stream': subreddit.stream.submissions(skip_existing=skip_existing, pause_after=0), 'wait': 1, 'next_poll': 0}]
+            if MODERATE_COMMENTS:
+                streams.append({'stream': subreddit.stream.comments(skip_existing=skip_existing, pause_after=0), 'wait': 1, 'next_poll': 0})
+            last_cleanup = 0
+            while True:
+                for entry in streams:
+                    if time.time() < entry['next_poll']:
+                        continue
+                    # Take at most one batch per turn: a stream that has new items on every poll would
+                    # otherwise never yield None, leaving its items unqueued and the other stream unread
+                    items = []
+                    for item in entry['stream']:
+                        if item is None:
+                            break
+                        items.append(item)
+                        if len(items) >= JOB_BATCH_SIZE:
+                            break
+                    enqueue_items(conn, items)
+                    # pause_after=0 skips PRAW's own backoff, so back off here while a stream has nothing new
+                    if items:
+                        entry['wait'] = 1
+                        entry['next_poll'] = 0
+                    else:
+                        entry['next_poll'] = time.time() + entry['wait']
+                        entry['wait'] = min(entry['wait'] * 2, STREAM_MAX_BACKOFF)
+                if time.time() - last_cleanup > 3600:
+                    clean_old_jobs(conn)
+                    clean_old_signatures(conn)
+                    maintain_partitions(conn)
+                    last_cleanup = time.time()
+                time.sleep(max(0, min(entry['next_poll'] for entry in streams) - time.time()))
+        except Exception as e:
+            print(f"Stream leader error: {e}. Retrying in 5s...")
+            time.sleep(5)
+        finally:
+            if conn is not None and not conn.closed:
+                conn.close()
 
-            # 3. Determine Limit
-            limit = get_limit_for_user(total_karma)
-            
-            # 4. Check how many posts they made in last 24h
-            current_count = get_user_post_count(conn, author.name)
+def run_worker(conn):
+    """Claims queued submissions/comments and runs the rule and limit logic on them."""
+    reddit = get_reddit()
+    listen_conn = get_db_connection()
+    listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    listen_conn.cursor().execute(f"LISTEN {JOB_CHANNEL}")
+    print(f"[{WORKER_ID}] Worker ready.")
 
-            print(f"New post by {author.name} (Karma: {total_karma}). Count: {current_count}. Limit: {limit}")
+    while True:
+        try:
+            job_ids = claim_jobs(conn)
+            if job_ids and len(job_ids) < JOB_BATCH_SIZE and JOB_BATCH_WINDOW > 0:
+                time.sleep(JOB_BATCH_WINDOW)
+                job_ids += claim_jobs(conn, JOB_BATCH_SIZE - len(job_ids))
+        except Exception as e:
+            print(f"Error claiming jobs: {e}")
+            conn.rollback()
+            job_ids = []
 
-            if current_count >= limit:
-                print(f" -> REMOVING post by {author.name}")
-                
-                if TEST_MODE:
-                    print(f"[TEST MODE] Would remove post {submission.id} by {author.name}")
-                    print(f"[TEST MODE] Would reply to {author.name}")
+        if not job_ids:
+            # Sleep until the leader announces a new job (or poll for abandoned ones)
+            if select.select([listen_conn], [], [], JOB_POLL_INTERVAL) != ([], [], []):
+                listen_conn.poll()
+                listen_conn.notifies.clear()
+            continue
+
+        # Fetch the whole batch (submissions and comments together) in one API call
+        try:
+            fetched = {item.fullname: item for item in reddit.info(fullnames=[job_fullname(job_id) for job_id in job_ids])}
+        except Exception as e:
+            print(f"Error fetching items: {e}")
+            for job_id in job_ids:
+                finish_job(conn, job_id, error=str(e))
+            continue
+
+        # Look up every submission author in the batch at once (one call per 100 uncached authors)
+        authors = {s.author.name: getattr(s, 'author_fullname', None) for s in fetched.values()
+                   if s.author and isinstance(s, praw.models.Submission)}
+        try:
+            karma_cache = lookup_karma(reddit, conn, authors, KARMA_CACHE_TTL)
+        except Exception as e:
+            print(f"Error looking up authors: {e}")
+            conn.rollback()
+            karma_cache = {}
+
+        done = []
+        for job_id in job_ids:
+            item = fetched.get(job_fullname(job_id))
+            if item is None:
+                finish_job(conn, job_id, error="Item not found")
+                continue
+            try:
+                if isinstance(item, praw.models.Comment):
+                    process_comment(reddit, conn, item)
                 else:
-                    # Remove the post
-                    submission.mod.remove(mod_note="Daily post limit exceeded")
-                    
-                    # Reply to user
-                    reply_text = (
-                        f"Hi /u/{author.name}, your post has been removed because you have reached your daily posting limit.\n\n"
-                        f"Your account has **{total_karma} karma**, which limits you to **{limit} post(s)** per 24 hours.\n\n"
-                        "Please try again tomorrow!"
-                    )
-                    submission.reply(reply_text).mod.distinguish(sticky=True)
-                
-                details = f"Karma: {total_karma}, Limit: {limit}"
-                action_type = "REMOVE_LIMIT"
-                if TEST_MODE:
-                    action_type = f"TEST_{action_type}"
-                log_mod_action(conn, action_type, author.name, details, submission.id)
-            else:
-                # Log the valid post
-                log_post(conn, author.name)
+                    process_submission(reddit, conn, item, karma_cache)
+                done.append(job_id)
+            except Exception as e:
+                print(f"Error processing {job_id}: {e}")
+                conn.rollback()
+                finish_job(conn, job_id, error=str(e))
+        finish_jobs(conn, done)
+
+def run_modmail_sync():
+    """Keeps the modmail mirror current. One replica syncs at a time (advisory lock), at background priority."""
+    while True:
+        conn = None
+        try:
+            conn = get_db_connection()
+            c = conn.cursor()
+            c.execute("SELECT pg_try_advisory_lock(%s)", (MODMAIL_LOCK_ID,))
+            if not c.fetchone()[0]:
+                conn.close()
+                time.sleep(MODMAIL_SYNC_INTERVAL)
+                continue
+            conn.commit()
 
+            reddit = get_reddit(BACKGROUND)
+            last_reconcile = 0
+            while True:
+                fetched = modmail_sync.sync_modmail(reddit, conn, SUBREDDIT_NAMES, backfill=MODMAIL_BACKFILL)
+                if fetched:
+                    print(f"Synced {fetched} updated modmail conversation(s)")
+                if time.time() - last_reconcile > MODMAIL_RECONCILE_INTERVAL:
+                    archived = modmail_sync.reconcile_states(reddit, conn, SUBREDDIT_NAMES)
+                    if archived:
+                        print(f"Marked {archived} modmail conversation(s) archived on Reddit")
+                    last_reconcile = time.time()
+                time.sleep(MODMAIL_SYNC_INTERVAL)
         except Exception as e:
-            print(f"Error processing post: {e}")
+            print(f"Modmail sync error: {e}. Retrying in {MODMAIL_SYNC_INTERVAL}s...")
+            time.sleep(MODMAIL_SYNC_INTERVAL)
+        finally:
+            if conn is not None and not conn.closed:
+                conn.close()
+
+def main():
+    # Check for missing credentials
+    if not all([REDDIT_CLIENT_ID, REDDIT_CLIENT_SECRET, REDDIT_USERNAME, REDDIT_PASSWORD]):
+        print("Error: Missing Reddit credentials. Please check your .env file.")
+        return
+
+    if BOT_ROLE not in ('all', 'stream', 'worker'):
+        print(f"Error: Unknown BOT_ROLE '{BOT_ROLE}'. Use all, stream or worker.")
+        return
+
+    conn = init_db()
+    load_config(conn)
+    sync_signatures(conn)
+    print(f"Loaded {len(near_duplicate_index)} recent post signatures for near-duplicate detection")
+    threading.Thread(target=listen_for_config_changes, daemon=True).start()
+    
+    print(f"Starting bot for /r/{'+'.join(SUBREDDIT_NAMES)} as {WORKER_ID} (role: {BOT_ROLE})")
+    if TEST_MODE:
+        print("!!! RUNNING IN TEST MODE - No actions will be taken on Reddit !!!")
+
+    if MODMAIL_SYNC_INTERVAL > 0 and BOT_ROLE in ('all', 'stream'):
+        threading.Thread(target=run_modmail_sync, daemon=True).start()
+
+    if BOT_ROLE == 'stream':
+        run_stream_leader()
+        return
+
+    if BOT_ROLE == 'all':
+        threading.Thread(target=run_stream_leader, daemon=True).start()
+    run_worker(conn)
 
 if __name__ == "__main__":
     main()
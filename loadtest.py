@@ -0,0 +1,449 @@
+"""Load test for the web dashboard, with a seeded database and a fake Reddit backend.
+
+Point the DB_* settings at a scratch database first; seeding writes a lot of synthetic data.
+
+    python loadtest.py seed --actions 1000000 --reset
+    python loadtest.py run --moderators 10 --duration 60 --reddit-latency 0.3 --max-p95 500
+
+`run` starts gunicorn (with the same worker settings as docker-compose.yml) serving web.py,
+with get_bot_reddit() swapped for FakeReddit. Simulated moderators then hit the main routes
+concurrently, revalidating with ETags like a browser would, while a background writer logs new
+actions the way the bot does. It prints p50/p95/p99 latency and throughput per route, and exits
+with status 1 if a route breaks --max-p95 or --max-error-rate, so it can gate deploys.
+"""
+import argparse
+import csv
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+from http.cookiejar import CookieJar
+
+# Fake Reddit settings (read by the gunicorn workers through the environment)
+REDDIT_LATENCY = float(os.getenv('LOADTEST_REDDIT_LATENCY', '0.3'))
+QUEUE_SIZE = int(os.getenv('LOADTEST_QUEUE_SIZE', '100'))
+
+WORDS = ['train', 'bus', 'ferry', 'metro', 'light', 'rail', 'opal', 'central', 'north', 'west',
+         'harbour', 'city', 'express', 'platform', 'signal', 'track', 'commuter', 'driver', 'guard', 'depot']
+RULE_MATCHES = {
+    'RULE_PROFANITY_FILTER': ['pricks?', 'c+u+n+t+([sy]|ing)?', 'tit(t(ie|y))?s?'],
+    'RULE_SPAM_FILTER': ['grab yours here', '(crypto|bit)coin', 'qt-shirt\\.com'],
+    'RULE_URL_SHORTENERS': ['bit.ly', 'tinyurl.com', 't.co'],
+    'RULE_BANNED_DOMAINS': ['twitter.com', 'x.com'],
+    'RULE_DISGUISED_LINKS': ['(\\[(?P<text>(http|www)\\S+)\\]\\((?!(?P=text))(http|www)\\S+\\))'],
+    'RULE_COPY-PASTE_SPAM': ['87% similar to abc123 by u/someone']
+}
+# Rough mix seen in production: mostly limit removals, then rules, then bans
+ACTION_WEIGHTS = {
+    'REMOVE_LIMIT': 50,
+    'RULE_PROFANITY_FILTER': 20,
+    'RULE_SPAM_FILTER': 10,
+    'RULE_URL_SHORTENERS': 6,
+    'RULE_BANNED_DOMAINS': 6,
+    'RULE_DISGUISED_LINKS': 2,
+    'RULE_COPY-PASTE_SPAM': 4,
+    'BAN_USER': 2
+}
+
+
+def base36(n):
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    out = ''
+    while n:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+    return out or '0'
+
+
+def make_usernames(count):
+    rng = random.Random(42)
+    return [f"{rng.choice(WORDS)}_{rng.choice(WORDS)}{i}" for i in range(count)]
+
+
+def pick_user(rng, usernames):
+    # Heavy-tailed, so a few users dominate the log the way repeat offenders do
+    return usernames[min(int(rng.paretovariate(1.2)) - 1, len(usernames) - 1)]
+
+
+def fake_action(rng, usernames, subreddits, moderators, timestamp):
+    action_type = rng.choices(list(ACTION_WEIGHTS), weights=list(ACTION_WEIGHTS.values()))[0]
+    sub = rng.choice(subreddits)
+    if action_type == 'BAN_USER':
+        target = pick_user(rng, usernames)
+        details = f"Banned u/{target} for {rng.choice(['7', '30', 'permanent'])} days. Reason: Spam"
+        return (action_type, rng.choice(moderators), details, timestamp, None, False, sub)
+    if action_type == 'REMOVE_LIMIT':
+        karma = rng.randint(0, 600)
+        details = f"Karma: {karma}, Limit: {1 if karma < 250 else 2 if karma < 500 else 4}"
+        item_id = base36(rng.randint(10 ** 9, 10 ** 10))
+    else:
+        details = f"Match: {rng.choice(RULE_MATCHES[action_type])}"
+        item_id = base36(rng.randint(10 ** 9, 10 ** 10))
+        if rng.random() < 0.7:
+            item_id = f"t1_{item_id}"
+    return (action_type, pick_user(rng, usernames), details, timestamp, item_id, action_type != 'RULE_SPAM_FILTER', sub)
+
+
+def copy_rows(c, table, columns, rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    c.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def seed(args):
+    import bot
+
+    conn = bot.init_db()
+    c = conn.cursor()
+    subreddits = [name.lower() for name in bot.SUBREDDIT_NAMES]
+    moderators = [f"mod_{i}" for i in range(10)]
+    usernames = make_usernames(args.users)
+    rng = random.Random(7)
+    now = time.time()
+    earliest = now - args.days * 86400
+
+    if args.reset:
+        print("Clearing mod_actions, posts, user_notes, user_summary and page_cache...")
+        c.execute("TRUNCATE mod_actions, posts, user_notes, user_summary, page_cache")
+        conn.commit()
+
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (bot.SCHEMA_LOCK_ID,))
+    bot.create_partitions(c, since=datetime.fromtimestamp(earliest, timezone.utc))
+    conn.commit()
+
+    # Row triggers would turn a bulk load into millions of upserts; rebuild the summary once instead
+    c.execute("ALTER TABLE mod_actions DISABLE TRIGGER USER")
+    c.execute("ALTER TABLE user_notes DISABLE TRIGGER USER")
+    conn.commit()
+    try:
+        columns = ('action_type', 'username', 'details', 'timestamp', 'submission_id', 'can_approve', 'subreddit')
+        loaded = 0
+        while loaded < args.actions:
+            batch = min(100000, args.actions - loaded)
+            rows = [fake_action(rng, usernames, subreddits, moderators, rng.uniform(earliest, now)) for _ in range(batch)]
+            copy_rows(c, 'mod_actions', columns, rows)
+            conn.commit()
+            loaded += batch
+            print(f"  mod_actions: {loaded}/{args.actions}")
+
+        notes = {}
+        for _ in range(args.notes):
+            notes[pick_user(rng, usernames)] = (rng.choice(['Repeat spammer', 'Warned about links', 'Possible alt account', 'Ban evasion?']),
+                                                rng.uniform(earliest, now), rng.choice(moderators))
+        copy_rows(c, 'user_notes', ('username', 'note', 'timestamp', 'moderator'),
+                  [(name, note, ts, mod) for name, (note, ts, mod) in notes.items()])
+
+        copy_rows(c, 'posts', ('username', 'timestamp', 'subreddit', 'submission_id'),
+                  [(pick_user(rng, usernames), rng.uniform(now - bot.POST_RETENTION, now), rng.choice(subreddits),
+                    base36(rng.randint(10 ** 9, 10 ** 10))) for _ in range(args.posts)])
+        conn.commit()
+    finally:
+        c.execute("ALTER TABLE mod_actions ENABLE TRIGGER USER")
+        c.execute("ALTER TABLE user_notes ENABLE TRIGGER USER")
+        conn.commit()
+
+    print("Rebuilding user_summary...")
+    bot.rebuild_user_summary(c)
+    c.execute("UPDATE data_version SET version = version + 1")
+    conn.commit()
+
+    conn.autocommit = True
+    c.execute("ANALYZE mod_actions")
+    c.execute("ANALYZE posts")
+    c.execute("ANALYZE user_summary")
+    conn.close()
+    print(f"Seeded {args.actions} actions, {len(notes)} notes and {args.posts} posts for {args.users} users.")
+
+
+# ================= FAKE REDDIT =================
+
+class FakeObject:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class FakeModeration:
+    def __init__(self, reddit):
+        self.reddit = reddit
+
+    def modqueue(self, limit=None):
+        self.reddit.wait()
+        return self.reddit.queue[:limit] if limit else list(self.reddit.queue)
+
+    def approve(self):
+        self.reddit.wait()
+
+    def remove(self, spam=False, mod_note=None):
+        self.reddit.wait()
+
+    def ignore_reports(self):
+        self.reddit.wait()
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, name):
+        self.display_name = name.split('+')[0]
+        self.mod = FakeModeration(reddit)
+
+
+class FakeReddit:
+    """Stands in for praw.Reddit in the web app. Every call sleeps `latency` seconds, like a round trip."""
+
+    def __init__(self, latency, queue_size, subreddits):
+        self.latency = latency
+        usernames = make_usernames(max(queue_size, 1))
+        rng = random.Random(3)
+        self.queue = []
+        for i in range(queue_size):
+            author = rng.choice(usernames)
+            is_comment = rng.random() < 0.6
+            self.queue.append(FakeObject(
+                fullname=f"{'t1' if is_comment else 't3'}_{base36(rng.randint(10 ** 9, 10 ** 10))}",
+                author=FakeObject(name=author),
+                body='Synthetic reported comment ' * rng.randint(1, 20),
+                title=f"Synthetic post {i}",
+                selftext='Synthetic body text ' * rng.randint(0, 20),
+                user_reports=[['Spam', rng.randint(1, 3)]],
+                mod_reports=[],
+                created_utc=time.time() - rng.uniform(0, 86400),
+                permalink=f"/r/{subreddits[0]}/comments/{i}/",
+                subreddit=FakeObject(display_name=rng.choice(subreddits))
+            ))
+
+    def wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def info(self, fullnames=None):
+        self.wait()
+        return [FakeObject(fullname=name, mod=FakeModeration(self)) for name in fullnames or []]
+
+
+def create_app():
+    """gunicorn entry point (loadtest:create_app()): web.py with Reddit replaced by FakeReddit."""
+    import web
+    from flask import session
+
+    fake = FakeReddit(REDDIT_LATENCY, QUEUE_SIZE, web.SUBREDDIT_NAMES)
+    web.get_bot_reddit = lambda priority=None: fake
+
+    @web.app.route('/loadtest/login/<name>')
+    def loadtest_login(name):
+        session['user'] = name
+        return 'ok'
+
+    return web.app
+
+
+# ================= DRIVER =================
+
+def route_mix(usernames):
+    """(label, weight, url factory) for the routes a moderator's session hits."""
+    return [
+        ('/', 5, lambda rng: f"/?page={rng.randint(1, 3)}"),
+        ('/?search', 2, lambda rng: f"/?search=user:{pick_user(rng, usernames)}"),
+        ('/stats', 2, lambda rng: '/stats'),
+        ('/modqueue', 2, lambda rng: '/modqueue'),
+        ('/export_csv', 1, lambda rng: f"/export_csv?search=user:{pick_user(rng, usernames)}"),
+        # The dashboard ticker polls this every 5 seconds per open tab
+        ('/api/recent_actions', 8, lambda rng: '/api/recent_actions')
+    ]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)]
+
+
+class Moderator(threading.Thread):
+    def __init__(self, index, base_url, routes, deadline, think, results):
+        super().__init__(daemon=True)
+        self.name = f"mod_{index}"
+        self.base_url = base_url
+        self.routes = routes
+        self.deadline = deadline
+        self.think = think
+        self.results = results
+        self.rng = random.Random(index)
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()))
+        self.etags = {}
+
+    def run(self):
+        self.opener.open(f"{self.base_url}/loadtest/login/{self.name}").read()
+        labels = [r[0] for r in self.routes]
+        weights = [r[1] for r in self.routes]
+        factories = {r[0]: r[2] for r in self.routes}
+        while time.time() < self.deadline:
+            label = self.rng.choices(labels, weights=weights)[0]
+            path = factories[label](self.rng)
+            req = urllib.request.Request(self.base_url + path)
+            if path in self.etags:
+                req.add_header('If-None-Match', self.etags[path])
+            start = time.perf_counter()
+            try:
+                with self.opener.open(req, timeout=120) as resp:
+                    resp.read()
+                    status = resp.status
+                    if resp.headers.get('ETag'):
+                        self.etags[path] = resp.headers['ETag']
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except Exception:
+                status = 0
+            self.results.append((label, time.perf_counter() - start, status))
+            if self.think:
+                time.sleep(self.rng.uniform(0, self.think * 2))
+
+
+def write_actions(deadline, interval, usernames, subreddits):
+    """Logs new actions the way the bot does, so caches get invalidated during the run."""
+    import bot
+    conn = bot.get_db_connection()
+    rng = random.Random(11)
+    while time.time() < deadline:
+        action = fake_action(rng, usernames, subreddits, ['mod_0'], time.time())
+        bot.log_mod_action(conn, *action[:3], submission_id=action[4], can_approve=action[5], subreddit=action[6])
+        time.sleep(interval)
+    conn.close()
+
+
+def wait_for_server(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"{base_url}/api/recent_actions", timeout=2)
+            return True
+        except urllib.error.HTTPError:
+            return True
+        except Exception:
+            time.sleep(0.5)
+    return False
+
+
+def report(results, duration):
+    by_route = {}
+    for label, latency, status in results:
+        by_route.setdefault(label, []).append((latency, status))
+
+    rows = []
+    for label, samples in sorted(by_route.items()):
+        latencies = sorted(latency * 1000 for latency, _ in samples)
+        errors = sum(1 for _, status in samples if status == 0 or status >= 400)
+        rows.append({
+            'route': label,
+            'requests': len(samples),
+            'errors': errors,
+            'not_modified': sum(1 for _, status in samples if status == 304),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'rps': round(len(samples) / duration, 2)
+        })
+
+    print(f"\n{'Route':<22}{'Reqs':>7}{'Errors':>8}{'304s':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}")
+    for row in rows:
+        print(f"{row['route']:<22}{row['requests']:>7}{row['errors']:>8}{row['not_modified']:>7}"
+              f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['rps']:>9}")
+    print(f"\nTotal: {len(results)} requests in {duration:.0f}s ({len(results) / duration:.1f} req/s)")
+    return rows
+
+
+def run(args):
+    import bot
+
+    env = dict(os.environ, LOADTEST_REDDIT_LATENCY=str(args.reddit_latency), LOADTEST_QUEUE_SIZE=str(args.queue_size))
+    base_url = f"http://127.0.0.1:{args.port}"
+    server = subprocess.Popen(['gunicorn', '-w', str(args.workers), '--worker-class', 'gthread', '--threads', str(args.threads),
+                               '--timeout', '60', '-b', f"127.0.0.1:{args.port}", 'loadtest:create_app()'],
+                              env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        if not wait_for_server(base_url):
+            print("gunicorn did not start in time")
+            return 1
+
+        usernames = make_usernames(args.users)
+        subreddits = [name.lower() for name in bot.SUBREDDIT_NAMES]
+        routes = [r for r in route_mix(usernames) if not args.routes or r[0] in args.routes]
+        deadline = time.time() + args.duration
+        results = []
+
+        threads = [Moderator(i, base_url, routes, deadline, args.think, results) for i in range(args.moderators)]
+        if args.action_interval > 0:
+            threads.append(threading.Thread(target=write_actions, args=(deadline, args.action_interval, usernames, subreddits), daemon=True))
+        print(f"Running {args.moderators} moderators for {args.duration}s against {args.workers} gunicorn workers "
+              f"(Reddit latency {args.reddit_latency}s)...")
+        started = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        rows = report(results, time.time() - started)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'routes': rows}, f, indent=2)
+
+    failed = False
+    for row in rows:
+        if args.max_p95 and row['p95_ms'] > args.max_p95:
+            print(f"FAIL: {row['route']} p95 {row['p95_ms']}ms is above {args.max_p95}ms")
+            failed = True
+        if row['requests'] and row['errors'] / row['requests'] > args.max_error_rate:
+            print(f"FAIL: {row['route']} error rate {row['errors'] / row['requests']:.1%} is above {args.max_error_rate:.1%}")
+            failed = True
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a scratch database and load test the web dashboard.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = sub.add_parser('seed', help="Fill the database with synthetic actions, notes and posts")
+    seed_parser.add_argument('--actions', type=int, default=1000000)
+    seed_parser.add_argument('--users', type=int, default=20000)
+    seed_parser.add_argument('--notes', type=int, default=500)
+    seed_parser.add_argument('--posts', type=int, default=5000)
+    seed_parser.add_argument('--days', type=int, default=180, help="Spread actions over this many days")
+    seed_parser.add_argument('--reset', action='store_true', help="Empty the tables first")
+
+    run_parser = sub.add_parser('run', help="Start gunicorn with a fake Reddit backend and drive the main routes")
+    run_parser.add_argument('--moderators', type=int, default=10)
+    run_parser.add_argument('--duration', type=int, default=60)
+    run_parser.add_argument('--think', type=float, default=0.5, help="Average pause (seconds) between a moderator's requests")
+    run_parser.add_argument('--reddit-latency', type=float, default=REDDIT_LATENCY)
+    run_parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help="Items in the fake mod queue")
+    run_parser.add_argument('--users', type=int, default=20000, help="Must match the seed so searches find users")
+    run_parser.add_argument('--action-interval', type=float, default=5, help="Seconds between logged actions (0 disables)")
+    run_parser.add_argument('--workers', type=int, default=4)
+    run_parser.add_argument('--threads', type=int, default=8)
+    run_parser.add_argument('--port', type=int, default=5055)
+    run_parser.add_argument('--routes', nargs='*', help="Only drive these routes (labels as printed in the report)")
+    run_parser.add_argument('--json', help="Also write the results to this file")
+    run_parser.add_argument('--max-p95', type=float, help="Fail if any route's p95 (ms) is above this")
+    run_parser.add_argument('--max-error-rate', type=float, default=0.01)
+
+    args = parser.parse_args()
+    if args.command == 'seed':
+        seed(args)
+        return 0
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
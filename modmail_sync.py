@@ -0,0 +1,150 @@
+"""Postgres mirror of modmail, so the web app can list and read conversations without calling Reddit.
+
+The bot syncs incrementally: conversations are listed most recently updated first, and only
+ones whose last_updated moved past what's stored are fetched in full. Listing stops at the
+per-state watermark once the first page has been refreshed (to pick up archive/highlight changes).
+"""
+import time
+from datetime import datetime
+
+# Reddit's conversation states (the 'all' listing excludes archived)
+STATE_NEW = 0
+STATE_IN_PROGRESS = 1
+STATE_ARCHIVED = 2
+SYNC_LISTINGS = ('all', 'archived')
+
+
+def parse_date(value):
+    """Converts Reddit's ISO 8601 modmail timestamps to epoch seconds (parsed once, at sync time)."""
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def create_tables(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS modmail_conversations
+                 (id TEXT PRIMARY KEY, subreddit TEXT, subject TEXT, participant TEXT, state INTEGER,
+                  is_highlighted BOOLEAN, num_messages INTEGER, last_updated DOUBLE PRECISION, synced_at DOUBLE PRECISION)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_modmail_conversations_updated ON modmail_conversations (last_updated DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_modmail_conversations_sub ON modmail_conversations (subreddit, state, last_updated DESC)")
+    c.execute('''CREATE TABLE IF NOT EXISTS modmail_messages
+                 (id TEXT PRIMARY KEY, conversation_id TEXT NOT NULL, author TEXT, body TEXT,
+                  date DOUBLE PRECISION, is_internal BOOLEAN)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_modmail_messages_conversation ON modmail_messages (conversation_id, date)")
+    c.execute('''CREATE TABLE IF NOT EXISTS modmail_sync_state
+                 (listing TEXT PRIMARY KEY, watermark DOUBLE PRECISION, synced_at DOUBLE PRECISION)''')
+
+
+def store_summary(c, conv):
+    """Upserts the conversation fields that come with the listing."""
+    c.execute('''INSERT INTO modmail_conversations (id, subreddit, subject, participant, state, is_highlighted, num_messages, last_updated, synced_at)
+                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                 ON CONFLICT (id) DO UPDATE SET subreddit = EXCLUDED.subreddit, subject = EXCLUDED.subject,
+                     participant = EXCLUDED.participant, state = EXCLUDED.state, is_highlighted = EXCLUDED.is_highlighted,
+                     num_messages = EXCLUDED.num_messages, last_updated = EXCLUDED.last_updated, synced_at = EXCLUDED.synced_at''',
+              (conv.id, conv.owner.display_name.lower(), conv.subject, conv.participant.name if conv.participant else None,
+               conv.state, conv.is_highlighted, conv.num_messages, parse_date(conv.last_updated), time.time()))
+
+
+def store_message(c, conversation_id, msg):
+    c.execute('''INSERT INTO modmail_messages (id, conversation_id, author, body, date, is_internal)
+                 VALUES (%s, %s, %s, %s, %s, %s)
+                 ON CONFLICT (id) DO UPDATE SET body = EXCLUDED.body, is_internal = EXCLUDED.is_internal''',
+              (msg.id, conversation_id, msg.author.name if msg.author else None, msg.body_markdown,
+               parse_date(msg.date), msg.is_internal))
+
+
+def store_conversation(conn, conv):
+    """Upserts a fully fetched conversation and all of its messages."""
+    c = conn.cursor()
+    store_summary(c, conv)
+    for msg in conv.messages:
+        store_message(c, conv.id, msg)
+    conn.commit()
+
+
+def store_reply(conn, conversation_id, msg):
+    """Records a reply sent from the web app without waiting for the next sync."""
+    c = conn.cursor()
+    store_message(c, conversation_id, msg)
+    # Replying to a new conversation moves it to In Progress
+    c.execute('''UPDATE modmail_conversations SET num_messages = num_messages + 1, last_updated = %s,
+                     state = CASE WHEN state = %s THEN %s ELSE state END
+                 WHERE id = %s''', (parse_date(msg.date) or time.time(), STATE_NEW, STATE_IN_PROGRESS, conversation_id))
+    conn.commit()
+
+
+def set_state(conn, conversation_id, state):
+    c = conn.cursor()
+    c.execute("UPDATE modmail_conversations SET state = %s WHERE id = %s", (state, conversation_id))
+    conn.commit()
+
+
+def sync_modmail(reddit, conn, subreddit_names, refresh=25, backfill=200):
+    """Mirrors new and updated conversations for the given subreddits. Returns how many were fetched in full.
+
+    The first `refresh` conversations of each listing are always compared so state changes made on
+    Reddit show up; beyond that, listing stops at the stored watermark (or after `backfill` on the first run).
+    """
+    c = conn.cursor()
+    subreddit = reddit.subreddit(subreddit_names[0])
+    fetched = 0
+
+    for listing in SYNC_LISTINGS:
+        c.execute("SELECT watermark FROM modmail_sync_state WHERE listing = %s", (listing,))
+        row = c.fetchone()
+        watermark = row[0] if row else None
+        newest = watermark or 0
+        conn.commit()
+
+        seen = 0
+        for conv in subreddit.modmail.conversations(state=listing, sort='recent', limit=None,
+                                                    other_subreddits=subreddit_names[1:] or None):
+            seen += 1
+            last_updated = parse_date(conv.last_updated)
+            if watermark is None and seen > backfill:
+                break
+            if watermark is not None and last_updated <= watermark and seen > refresh:
+                break
+            newest = max(newest, last_updated)
+
+            c.execute("SELECT last_updated FROM modmail_conversations WHERE id = %s", (conv.id,))
+            row = c.fetchone()
+            if row is None or row[0] is None or last_updated > row[0]:
+                # New messages since the last sync; fetch the whole conversation once
+                store_conversation(conn, subreddit.modmail(conv.id))
+                fetched += 1
+            else:
+                store_summary(c, conv)
+                conn.commit()
+
+        c.execute('''INSERT INTO modmail_sync_state (listing, watermark, synced_at) VALUES (%s, %s, %s)
+                     ON CONFLICT (listing) DO UPDATE SET watermark = EXCLUDED.watermark, synced_at = EXCLUDED.synced_at''',
+                  (listing, newest, time.time()))
+        conn.commit()
+
+    return fetched
+
+
+def reconcile_states(reddit, conn, subreddit_names):
+    """Walks the whole unarchived listing and marks mirrored conversations missing from it as archived.
+
+    Archiving on Reddit doesn't move last_updated, so sync_modmail only notices it within the first
+    `refresh` conversations. Open conversations are few, so a full pass is cheap. Returns how many
+    conversations were marked archived.
+    """
+    c = conn.cursor()
+    subreddit = reddit.subreddit(subreddit_names[0])
+    started = time.time()
+    seen = []
+    for conv in subreddit.modmail.conversations(state='all', sort='recent', limit=None,
+                                                other_subreddits=subreddit_names[1:] or None):
+        store_summary(c, conv)
+        seen.append(conv.id)
+    # Anything synced after the walk began may be newer than the listing that was read
+    c.execute('''UPDATE modmail_conversations SET state = %s
+                 WHERE state <> %s AND subreddit = ANY(%s) AND NOT (id = ANY(%s)) AND synced_at < %s''',
+              (STATE_ARCHIVED, STATE_ARCHIVED, [name.lower() for name in subreddit_names], seen, started))
+    archived = c.rowcount
+    conn.commit()
+    return archived
@@ -0,0 +1,113 @@
+"""MinHash/LSH index used to spot near-duplicate posts made from different accounts."""
+import hashlib
+import random
+import re
+import time
+from array import array
+from collections import deque
+
+# Hash values are reduced modulo this prime so they fit in a Postgres BIGINT
+MERSENNE_PRIME = (1 << 61) - 1
+SHINGLE_SIZE = 3
+# Shorter text gets no signature: common short titles ("Train delays?") from different
+# people would otherwise look like copy-paste spam
+MIN_SHINGLES = 5
+
+
+def shingles(text):
+    """Splits text into overlapping lowercase word 3-grams (none if it has fewer than 3 words)."""
+    words = re.findall(r'\w+', text.lower())
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+class NearDuplicateIndex:
+    """Bounded in-memory LSH index over MinHash signatures of recent posts.
+
+    Signatures are split into bands; two posts become candidates if any band matches
+    exactly, and candidates are then confirmed with the estimated Jaccard similarity.
+    Entries older than max_age seconds, or beyond max_items, are evicted oldest first.
+    """
+
+    def __init__(self, num_perm=64, bands=16, max_age=7 * 86400, max_items=20000):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_age = max_age
+        self.max_items = max_items
+
+        # Fixed seed so every process (and every restart) produces comparable signatures
+        rng = random.Random(1)
+        self._perms = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME)) for _ in range(num_perm)]
+
+        self._items = {}       # item_id -> (author, timestamp, signature)
+        self._order = deque()  # item_ids, oldest first
+        self._buckets = {}     # (band, band_hash) -> set of item_ids
+
+    def __len__(self):
+        return len(self._items)
+
+    def signature(self, text):
+        """Returns the MinHash signature for text, or None if it's too short to compare.
+
+        Short titles are left out (run with `python -m doctest near_duplicates.py`):
+
+        >>> index = NearDuplicateIndex()
+        >>> index.signature("Train delays?") is None, index.signature("train delays on the T1 line") is None
+        (True, True)
+        >>> index.add('a', 'alice', time.time(), index.signature("Buy cheap Opal cards here before they sell out today"))
+        >>> index.query(index.signature("buy cheap opal cards here before they sell out today!"), 0.8, exclude_author='bob')[:2]
+        ('a', 'alice')
+        """
+        tokens = shingles(text or '')
+        if len(tokens) < MIN_SHINGLES:
+            return None
+        hashed = [int.from_bytes(hashlib.blake2b(t.encode(), digest_size=8).digest(), 'big') % MERSENNE_PRIME for t in tokens]
+        return array('q', (min((a * h + b) % MERSENNE_PRIME for h in hashed) for a, b in self._perms))
+
+    def _band_keys(self, signature):
+        return [(band, hash(tuple(signature[band * self.rows:(band + 1) * self.rows]))) for band in range(self.bands)]
+
+    def add(self, item_id, author, timestamp, signature):
+        if signature is None or item_id in self._items or len(signature) != self.num_perm:
+            return
+        self._items[item_id] = (author, timestamp, signature)
+        self._order.append(item_id)
+        for key in self._band_keys(signature):
+            self._buckets.setdefault(key, set()).add(item_id)
+        self._expire()
+
+    def _remove(self, item_id):
+        _, _, signature = self._items.pop(item_id)
+        for key in self._band_keys(signature):
+            bucket = self._buckets.get(key)
+            if bucket:
+                bucket.discard(item_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def _expire(self, now=None):
+        cutoff = (now or time.time()) - self.max_age
+        while self._order and (len(self._order) > self.max_items or self._items[self._order[0]][1] < cutoff):
+            self._remove(self._order.popleft())
+
+    def query(self, signature, threshold, exclude_author=None):
+        """Returns (item_id, author, similarity) for the closest post by another author at or above threshold."""
+        if signature is None:
+            return None
+        self._expire()
+
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates |= self._buckets.get(key, set())
+
+        best = None
+        for item_id in candidates:
+            author, _, other = self._items[item_id]
+            if exclude_author and author and author.lower() == exclude_author.lower():
+                continue
+            similarity = sum(1 for x, y in zip(signature, other) if x == y) / self.num_perm
+            if similarity >= threshold and (best is None or similarity > best[2]):
+                best = (item_id, author, similarity)
+        return best
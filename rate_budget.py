@@ -0,0 +1,151 @@
+"""Reddit API rate budget shared by the bot and the web app through Postgres.
+
+Both processes use the same Reddit credentials, so they share one rate limit window.
+Every HTTP request PRAW makes goes through BudgetedRequestor, which takes a unit from
+the shared budget first and afterwards copies Reddit's X-Ratelimit headers back into
+it. Lower-priority callers have to leave a reserve for the ones above them, so bot
+enforcement keeps working when moderators run bulk actions mid-spam-wave.
+"""
+import os
+import threading
+import time
+
+from prawcore import Requestor
+
+# Priorities (lower runs first)
+ENFORCEMENT = 0
+INTERACTIVE = 1
+BACKGROUND = 2
+
+# Reddit allows roughly 1000 requests per 10 minute window per OAuth client
+DEFAULT_CAPACITY = int(os.getenv('RATE_BUDGET_CAPACITY', '1000'))
+DEFAULT_WINDOW = 600
+
+# Share of the window each priority must leave untouched for higher priorities
+RESERVES = {
+    ENFORCEMENT: 0.0,
+    INTERACTIVE: float(os.getenv('RATE_BUDGET_INTERACTIVE_RESERVE', '0.1')),
+    BACKGROUND: float(os.getenv('RATE_BUDGET_BACKGROUND_RESERVE', '0.3'))
+}
+
+# How long (seconds) each priority waits for budget before giving up
+MAX_WAIT = {
+    ENFORCEMENT: float('inf'),
+    INTERACTIVE: float(os.getenv('RATE_BUDGET_INTERACTIVE_WAIT', '5')),
+    BACKGROUND: float('inf')
+}
+
+
+class RateBudgetExceeded(Exception):
+    """Raised when a caller can't get budget within its wait limit."""
+
+
+class RateBudget:
+    """Fixed-window request budget kept in the reddit_rate_budget table."""
+
+    def __init__(self, connect, key='default'):
+        self.connect = connect
+        self.key = key
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _cursor(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self.connect()
+            c = self._conn.cursor()
+            c.execute('''CREATE TABLE IF NOT EXISTS reddit_rate_budget
+                         (key TEXT PRIMARY KEY, remaining DOUBLE PRECISION, capacity DOUBLE PRECISION,
+                          reset_at DOUBLE PRECISION, updated_at DOUBLE PRECISION)''')
+            c.execute('''INSERT INTO reddit_rate_budget (key, remaining, capacity, reset_at, updated_at)
+                         VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING''',
+                      (self.key, DEFAULT_CAPACITY, DEFAULT_CAPACITY, time.time() + DEFAULT_WINDOW, time.time()))
+            self._conn.commit()
+        return self._conn.cursor()
+
+    def _try_acquire(self, priority):
+        """Takes one request from the budget. Returns 0 on success, else seconds until the window resets."""
+        c = self._cursor()
+        now = time.time()
+        c.execute("SELECT remaining, capacity, reset_at FROM reddit_rate_budget WHERE key = %s FOR UPDATE", (self.key,))
+        remaining, capacity, reset_at = c.fetchone()
+        if now >= reset_at:
+            # New window; Reddit's headers will correct this after the first response
+            remaining, reset_at = capacity, now + DEFAULT_WINDOW
+
+        if remaining - 1 < capacity * RESERVES[priority]:
+            self._conn.commit()
+            return max(reset_at - now, 0.1)
+
+        c.execute("UPDATE reddit_rate_budget SET remaining = %s, reset_at = %s, updated_at = %s WHERE key = %s",
+                  (remaining - 1, reset_at, now, self.key))
+        self._conn.commit()
+        return 0
+
+    def acquire(self, priority):
+        deadline = time.time() + MAX_WAIT[priority]
+        while True:
+            with self._lock:
+                try:
+                    wait = self._try_acquire(priority)
+                except Exception as e:
+                    # Never let the budget table stop enforcement; fall back to PRAW's own limiter
+                    print(f"Rate budget unavailable ({e}); continuing without it")
+                    self._reset_connection()
+                    return
+            if wait == 0:
+                return
+            if time.time() + wait > deadline:
+                raise RateBudgetExceeded(f"Reddit rate budget is reserved for higher priority work. Try again in {int(wait) + 1}s.")
+            time.sleep(min(wait, 1))
+
+    def update_from_headers(self, headers):
+        """Replaces the estimate with the remaining/reset values Reddit reported."""
+        remaining = headers.get('x-ratelimit-remaining')
+        reset = headers.get('x-ratelimit-reset')
+        used = headers.get('x-ratelimit-used')
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            try:
+                remaining = float(remaining)
+                capacity = remaining + float(used) if used is not None else None
+                c = self._cursor()
+                c.execute('''UPDATE reddit_rate_budget SET remaining = %s, reset_at = %s, updated_at = %s,
+                             capacity = COALESCE(%s, capacity) WHERE key = %s''',
+                          (remaining, time.time() + float(reset), time.time(), capacity, self.key))
+                self._conn.commit()
+            except Exception as e:
+                print(f"Could not record rate limit headers: {e}")
+                self._reset_connection()
+
+    def _reset_connection(self):
+        try:
+            if self._conn is not None:
+                self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+
+class BudgetedRequestor(Requestor):
+    """prawcore Requestor that checks the shared budget before every HTTP request.
+
+    Pass it to praw.Reddit as requestor_class, with requestor_kwargs
+    {'budget': RateBudget(...), 'priority': ENFORCEMENT/INTERACTIVE/BACKGROUND}.
+    """
+
+    def __init__(self, *args, budget=None, priority=BACKGROUND, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+        self.priority = priority
+
+    def request(self, *args, **kwargs):
+        # prawcore's Session always passes its own default timeout, which would win over
+        # the one this requestor was created with (e.g. the web app's REDDIT_TIMEOUT)
+        kwargs['timeout'] = self.timeout
+        if self.budget is not None:
+            self.budget.acquire(self.priority)
+        response = super().request(*args, **kwargs)
+        if self.budget is not None:
+            self.budget.update_from_headers(response.headers)
+        return response
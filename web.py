@@ -1,13 +1,22 @@
-from flask import Flask, render_template, request, redirect, session, url_for, Response, jsonify
+from flask import Flask, render_template, request, redirect, session, url_for, Response, jsonify, make_response
 import psycopg2
+from psycopg2.extras import Json
+from werkzeug.http import is_resource_modified
+import hashlib
+import time
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import praw
 import uuid
 import yaml
-import shutil
+import difflib
 import csv
 import io
+import re
+import threading
+from functools import wraps
+from rate_budget import RateBudget, RateBudgetExceeded, BudgetedRequestor, INTERACTIVE
+import modmail_sync
 
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev_secret_key')
@@ -24,8 +33,22 @@ REDDIT_CLIENT_SECRET = os.getenv('REDDIT_CLIENT_SECRET')
 REDDIT_USER_AGENT = os.getenv('REDDIT_USER_AGENT', 'web:SydneyTrainsModLog:v1.0')
 REDDIT_REDIRECT_URI = os.getenv('REDDIT_REDIRECT_URI', 'http://localhost:5000/callback')
 SUBREDDIT_NAME = os.getenv('SUBREDDIT_NAME', 'SydneyTrains')
+# Several subreddits can be moderated together, e.g. "SydneyTrains+SydneyBuses"
+SUBREDDIT_NAMES = [name.strip() for name in re.split(r'[+,]', SUBREDDIT_NAME) if name.strip()]
 TEST_MODE = os.getenv('TEST_MODE', 'false').lower() == 'true'
 
+# Reddit Concurrency
+# Caps how many requests per worker may be talking to Reddit at once so slow
+# upstream calls can't tie up every thread and starve the DB-only pages.
+REDDIT_MAX_CONCURRENCY = int(os.getenv('REDDIT_MAX_CONCURRENCY', '3'))
+REDDIT_QUEUE_TIMEOUT = float(os.getenv('REDDIT_QUEUE_TIMEOUT', '5'))
+REDDIT_TIMEOUT = int(os.getenv('REDDIT_TIMEOUT', '15'))
+
+reddit_slots = threading.BoundedSemaphore(REDDIT_MAX_CONCURRENCY)
+
+# Explicit column list so the mod_actions.search_vector column isn't sent to the app
+ACTION_COLUMNS = 'id, action_type, username, details, timestamp, submission_id, can_approve, subreddit'
+
 def get_db_connection():
     conn = psycopg2.connect(
         host=DB_HOST,
@@ -35,24 +58,159 @@ def get_db_connection():
     )
     return conn
 
+# Reddit request budget shared with the bot (same credentials, same rate limit)
+reddit_budget = RateBudget(get_db_connection)
+
 def get_reddit_auth_instance():
+    # Logins use the moderator's own token, so they don't draw on the bot's budget
     return praw.Reddit(
         client_id=REDDIT_CLIENT_ID,
         client_secret=REDDIT_CLIENT_SECRET,
         redirect_uri=REDDIT_REDIRECT_URI,
-        user_agent=REDDIT_USER_AGENT
+        user_agent=REDDIT_USER_AGENT,
+        requestor_class=BudgetedRequestor,
+        requestor_kwargs={'timeout': REDDIT_TIMEOUT}
     )
 
-def get_bot_reddit():
+def get_bot_reddit(priority=INTERACTIVE):
     """Returns a PRAW instance authenticated as the bot for performing actions."""
     return praw.Reddit(
         client_id=REDDIT_CLIENT_ID,
         client_secret=REDDIT_CLIENT_SECRET,
         user_agent=REDDIT_USER_AGENT,
         username=os.getenv('REDDIT_USERNAME'),
-        password=os.getenv('REDDIT_PASSWORD')
+        password=os.getenv('REDDIT_PASSWORD'),
+        requestor_class=BudgetedRequestor,
+        requestor_kwargs={'budget': reddit_budget, 'priority': priority, 'timeout': REDDIT_TIMEOUT}
     )
 
+def get_subreddit_filter():
+    """Returns the lowercase subreddit selected via ?sub=, or '' for all configured subreddits."""
+    sub = request.args.get('sub', '').strip().lower()
+    return sub if sub in [name.lower() for name in SUBREDDIT_NAMES] else ''
+
+def like_escape(value):
+    """Escapes LIKE wildcards so user input is matched literally."""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def parse_search_query(search_query):
+    """Splits a log search into field filters (user:, type:, before:, after:) and free text."""
+    filters = {}
+    text = []
+    for token in search_query.split():
+        field, sep, value = token.partition(':')
+        field = field.lower()
+        if sep and value and field in ('user', 'type'):
+            if field == 'user' and value.lower().startswith('u/'):
+                value = value[2:]
+            filters[field] = value
+        elif sep and value and field in ('before', 'after'):
+            try:
+                filters[field] = datetime.strptime(value, '%Y-%m-%d').timestamp()
+            except ValueError:
+                text.append(token)
+        else:
+            text.append(token)
+    return filters, ' '.join(text)
+
+def build_action_filters(search_query='', sub='', order='time'):
+    """Returns a WHERE clause, ORDER BY clause and their params for filtering mod_actions.
+
+    Free text is matched against the search_vector full-text index (username, action type
+    and details), with trigram-indexed substring matching on username, action type and details
+    so partial words still work. order='relevance' ranks full-text matches first.
+    """
+    conditions = []
+    params = []
+    order_by = 'timestamp DESC'
+    order_params = []
+
+    filters, text = parse_search_query(search_query)
+    if 'user' in filters:
+        conditions.append('username ILIKE %s')
+        params.append(like_escape(filters['user']))
+    if 'type' in filters:
+        conditions.append('action_type ILIKE %s')
+        params.append(f"%{like_escape(filters['type'])}%")
+    if 'after' in filters:
+        conditions.append('timestamp >= %s')
+        params.append(filters['after'])
+    if 'before' in filters:
+        conditions.append('timestamp < %s')
+        params.append(filters['before'])
+    if text:
+        search_pattern = f"%{like_escape(text)}%"
+        conditions.append("(search_vector @@ websearch_to_tsquery('simple', %s) OR username ILIKE %s OR action_type ILIKE %s OR details ILIKE %s)")
+        params += [text, search_pattern, search_pattern, search_pattern]
+        if order == 'relevance':
+            order_by = "ts_rank(search_vector, websearch_to_tsquery('simple', %s)) DESC, timestamp DESC"
+            order_params = [text]
+    if sub:
+        conditions.append('subreddit = %s')
+        params.append(sub)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    return where, params, order_by, order_params
+
+def reddit_bound(f):
+    """Runs a route inside a bounded Reddit slot, returning 503 if none frees up in time.
+
+    Routes that catch their own errors must re-raise RateBudgetExceeded so it also becomes a 503.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not reddit_slots.acquire(timeout=REDDIT_QUEUE_TIMEOUT):
+            return "Reddit is busy handling other requests. Please try again in a moment.", 503
+        try:
+            return f(*args, **kwargs)
+        except RateBudgetExceeded as e:
+            return str(e), 503
+        finally:
+            reddit_slots.release()
+    return wrapper
+
+def cached_view(loader, render, key_suffix=''):
+    """Serves a read-only page from the shared page_cache.
+
+    loader(cur) runs the page's queries and returns a JSON-serializable result, which is cached
+    per route and query string until data_version moves (any write to mod_actions or user_notes).
+    Pages whose results also depend on the clock pass a key_suffix (e.g. today's date) so they
+    expire on their own. render(result) builds the response. Requests whose ETag/Last-Modified
+    still match get a 304.
+    """
+    key = request.full_path + key_suffix
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # One round trip: the current data version plus the cached result for it, if any
+        cur.execute('''SELECT v.version, p.result, p.created_at FROM data_version v
+                       LEFT JOIN page_cache p ON p.key = %s AND p.version = v.version''', (key,))
+        version, result, created_at = cur.fetchone()
+
+        # Pages show who's logged in, so the validator is per moderator
+        etag = hashlib.sha1(f"{version}:{session.get('user', '')}:{key}".encode()).hexdigest()
+        if not is_resource_modified(request.environ, etag=etag, last_modified=created_at and datetime.fromtimestamp(created_at, timezone.utc)):
+            response = make_response('', 304)
+        else:
+            if result is None:
+                result = loader(cur)
+                created_at = time.time()
+                cur.execute('''INSERT INTO page_cache (key, version, result, created_at) VALUES (%s, %s, %s, %s)
+                               ON CONFLICT (key) DO UPDATE SET version = EXCLUDED.version, result = EXCLUDED.result,
+                                   created_at = EXCLUDED.created_at''', (key, version, Json(result), created_at))
+                cur.execute("DELETE FROM page_cache WHERE version < %s", (version,))
+                conn.commit()
+            response = make_response(render(result))
+    finally:
+        cur.close()
+        conn.close()
+
+    response.set_etag(etag)
+    if created_at:
+        response.last_modified = datetime.fromtimestamp(created_at, timezone.utc)
+    # Browsers keep the page but check back every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/login')
 def login():
     reddit = get_reddit_auth_instance()
@@ -62,6 +220,7 @@ def login():
     return redirect(auth_url)
 
 @app.route('/callback')
+@reddit_bound
 def callback():
     code = request.args.get('code')
     state = request.args.get('state')
@@ -74,19 +233,22 @@ def callback():
         reddit.auth.authorize(code)
         user = reddit.user.me()
         
-        # Check if user is a moderator of the subreddit
+        # Check if user is a moderator of any configured subreddit
         # Note: We create a read-only instance or use the authenticated one to check
         is_mod = False
-        for mod in reddit.subreddit(SUBREDDIT_NAME).moderator():
-            if mod.name.lower() == user.name.lower():
-                is_mod = True
+        for name in SUBREDDIT_NAMES:
+            for mod in reddit.subreddit(name).moderator():
+                if mod.name.lower() == user.name.lower():
+                    is_mod = True
+                    break
+            if is_mod:
                 break
         
         if is_mod:
             session['user'] = user.name
             return redirect(url_for('index'))
         else:
-            return f"Sorry, you must be a moderator of r/{SUBREDDIT_NAME} to view this page.", 403
+            return f"Sorry, you must be a moderator of r/{'+'.join(SUBREDDIT_NAMES)} to view this page.", 403
             
     except Exception as e:
         return f"Authentication failed: {e}", 500
@@ -97,6 +259,7 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/approve/<item_id>')
+@reddit_bound
 def approve_item(item_id):
     if not session.get('user'):
         return redirect(url_for('login'))
@@ -114,10 +277,13 @@ def approve_item(item_id):
             submission.mod.approve()
         
         return redirect(request.referrer or url_for('index'))
+    except RateBudgetExceeded:
+        raise
     except Exception as e:
         return f"Error approving item: {e}", 500
 
 @app.route('/remove/<item_id>')
+@reddit_bound
 def remove_item(item_id):
     if not session.get('user'):
         return redirect(url_for('login'))
@@ -133,10 +299,13 @@ def remove_item(item_id):
             submission.mod.remove(spam=False)
             
         return redirect(request.referrer or url_for('index'))
+    except RateBudgetExceeded:
+        raise
     except Exception as e:
         return f"Error removing item: {e}", 500
 
 @app.route('/ignore_reports/<item_id>')
+@reddit_bound
 def ignore_reports_item(item_id):
     if not session.get('user'):
         return redirect(url_for('login'))
@@ -154,10 +323,13 @@ def ignore_reports_item(item_id):
             submission.mod.ignore_reports()
             
         return redirect(request.referrer or url_for('index'))
+    except RateBudgetExceeded:
+        raise
     except Exception as e:
         return f"Error ignoring reports for item: {e}", 500
 
 @app.route('/ban', methods=['POST'])
+@reddit_bound
 def ban_user():
     if not session.get('user'):
         return redirect(url_for('login'))
@@ -168,6 +340,9 @@ def ban_user():
         duration_str = request.form.get('duration')
         note = request.form.get('note')
         message = request.form.get('message')
+        sub_name = request.form.get('subreddit') or SUBREDDIT_NAMES[0]
+        if sub_name.lower() not in [name.lower() for name in SUBREDDIT_NAMES]:
+            return "Invalid subreddit.", 400
         
         duration = None
         if duration_str:
@@ -179,7 +354,7 @@ def ban_user():
                 return "Invalid duration format. Must be a number.", 400
 
         bot = get_bot_reddit()
-        subreddit = bot.subreddit(SUBREDDIT_NAME)
+        subreddit = bot.subreddit(sub_name)
         
         subreddit.banned.add(username, duration=duration, ban_reason=reason, note=note, ban_message=message)
         
@@ -187,15 +362,18 @@ def ban_user():
         conn = get_db_connection()
         cur = conn.cursor()
         details = f"Banned u/{username} for {duration or 'permanent'} days. Reason: {reason}"
-        cur.execute("INSERT INTO mod_actions (action_type, username, details, timestamp, can_approve) VALUES (%s, %s, %s, %s, %s)",
-                    ('BAN_USER', session.get('user'), details, datetime.now().timestamp(), False))
+        cur.execute("INSERT INTO mod_actions (action_type, username, details, timestamp, can_approve, subreddit) VALUES (%s, %s, %s, %s, %s, %s)",
+                    ('BAN_USER', session.get('user'), details, datetime.now().timestamp(), False, sub_name.lower()))
         conn.commit()
         
         return redirect(url_for('modqueue'))
+    except RateBudgetExceeded:
+        raise
     except Exception as e:
         return f"Error banning user: {e}", 500
 
 @app.route('/bulk_action', methods=['POST'])
+@reddit_bound
 def bulk_action():
     if not session.get('user'):
         return redirect(url_for('login'))
@@ -220,19 +398,23 @@ def bulk_action():
                     item.mod.ignore_reports()
                 
         return redirect(url_for('modqueue'))
+    except RateBudgetExceeded:
+        raise
     except Exception as e:
         return f"Error processing bulk action: {e}", 500
 
 @app.route('/modqueue')
+@reddit_bound
 def modqueue():
     if not session.get('user'):
         return redirect(url_for('login'))
     
     filter_type = request.args.get('type', 'all').lower()
     sort_order = request.args.get('sort', 'newest').lower()
+    sub = get_subreddit_filter()
     
     bot = get_bot_reddit()
-    subreddit = bot.subreddit(SUBREDDIT_NAME)
+    subreddit = bot.subreddit(sub or '+'.join(SUBREDDIT_NAMES))
     items = []
     
     try:
@@ -288,15 +470,27 @@ def modqueue():
                 'created': datetime.fromtimestamp(item.created_utc).strftime('%Y-%m-%d %H:%M'),
                 'created_utc': item.created_utc,
                 'permalink': f"https://reddit.com{item.permalink}",
-                'user_note': notes_map.get(author_name)
+                'user_note': notes_map.get(author_name),
+                'subreddit': item.subreddit.display_name
             })
             
         # Sort items
         items.sort(key=lambda x: x['created_utc'], reverse=(sort_order == 'newest'))
+    except RateBudgetExceeded:
+        raise
     except Exception as e:
         return f"Error fetching mod queue: {e}", 500
 
-    return render_template('modqueue.html', items=items, user=session.get('user'), current_filter=filter_type, current_sort=sort_order)
+    return render_template('modqueue.html', items=items, user=session.get('user'), current_filter=filter_type, current_sort=sort_order,
+                           subreddits=SUBREDDIT_NAMES, current_sub=sub)
+
+# Modmail listing states, as filters on the mirrored conversation state ('all' excludes archived, like Reddit)
+MODMAIL_STATES = {
+    'all': 'state <> 2',
+    'new': 'state = 0',
+    'inprogress': 'state = 1',
+    'archived': 'state = 2'
+}
 
 @app.route('/modmail')
 def modmail():
@@ -304,71 +498,92 @@ def modmail():
         return redirect(url_for('login'))
     
     state = request.args.get('state', 'all')
-    
-    bot = get_bot_reddit()
-    subreddit = bot.subreddit(SUBREDDIT_NAME)
-    conversations = []
-    
-    try:
-        conv_list = list(subreddit.modmail.conversations(state=state, limit=50))
-        
-        # Collect participants to check for notes
-        participants = set()
-        for conv in conv_list:
-            if conv.participant:
-                participants.add(conv.participant.name)
-        
-        notes_map = {}
-        if participants:
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT username FROM user_notes WHERE username = ANY(%s)", (list(participants),))
-            for row in cur.fetchall():
-                notes_map[row[0]] = True
-            cur.close()
-            conn.close()
+    if state not in MODMAIL_STATES:
+        state = 'all'
+    sub = get_subreddit_filter()
+    page = request.args.get('page', 1, type=int)
+    if page < 1:
+        page = 1
+    per_page = 50
+    offset = (page - 1) * per_page
 
-        for conv in conv_list:
-            participant_name = conv.participant.name if conv.participant else '[deleted]'
-            conversations.append({
-                'id': conv.id,
-                'subject': conv.subject,
-                'participant': participant_name,
-                'last_updated': datetime.fromisoformat(conv.last_updated.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M'),
-                'is_highlighted': conv.is_highlighted,
-                'num_messages': conv.num_messages,
-                'state': conv.state,
-                'has_note': notes_map.get(participant_name, False)
-            })
+    # Served from the mirror the bot keeps in sync (see modmail_sync.py), so viewing costs no API calls
+    where = f"WHERE {MODMAIL_STATES[state]}" + (" AND subreddit = %s" if sub else "")
+    params = [sub] if sub else []
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(f'''SELECT id, subject, participant, last_updated, is_highlighted, num_messages, state, subreddit,
+                              EXISTS (SELECT 1 FROM user_notes n WHERE n.username = m.participant)
+                       FROM modmail_conversations m {where} ORDER BY last_updated DESC LIMIT %s OFFSET %s''',
+                    params + [per_page, offset])
+        rows = cur.fetchall()
+        cur.execute(f"SELECT COUNT(*) FROM modmail_conversations {where}", params)
+        total_count = cur.fetchone()[0]
+        cur.execute("SELECT MIN(synced_at) FROM modmail_sync_state")
+        synced_at = cur.fetchone()[0]
     except Exception as e:
         return f"Error fetching modmail: {e}", 500
+    finally:
+        cur.close()
+        conn.close()
 
-    return render_template('modmail.html', conversations=conversations, user=session.get('user'), current_state=state)
+    conversations = []
+    for row in rows:
+        conversations.append({
+            'id': row[0],
+            'subject': row[1],
+            'participant': row[2] or '[deleted]',
+            'last_updated': datetime.fromtimestamp(row[3]).strftime('%Y-%m-%d %H:%M') if row[3] else '',
+            'is_highlighted': row[4],
+            'num_messages': row[5],
+            'state': row[6],
+            'has_note': row[8],
+            'subreddit': row[7]
+        })
+
+    total_pages = max((total_count + per_page - 1) // per_page, 1)
+    last_synced = datetime.fromtimestamp(synced_at).strftime('%Y-%m-%d %H:%M:%S') if synced_at else None
+
+    return render_template('modmail.html', conversations=conversations, user=session.get('user'), current_state=state,
+                           subreddits=SUBREDDIT_NAMES, current_sub=sub, page=page, total_pages=total_pages,
+                           last_synced=last_synced)
 
 @app.route('/modmail/<conversation_id>')
 def modmail_conversation(conversation_id):
     if not session.get('user'):
         return redirect(url_for('login'))
     
-    bot = get_bot_reddit()
-    subreddit = bot.subreddit(SUBREDDIT_NAME)
-    
+    conn = get_db_connection()
+    cur = conn.cursor()
     try:
-        conv = subreddit.modmail(conversation_id)
+        cur.execute("SELECT id, subject, state, subreddit FROM modmail_conversations WHERE id = %s", (conversation_id,))
+        row = cur.fetchone()
+        if not row:
+            return "Conversation not found. It may not have been synced yet.", 404
+        conversation = {'id': row[0], 'subject': row[1], 'state': row[2], 'subreddit': row[3]}
+
+        cur.execute("SELECT author, body, date, is_internal FROM modmail_messages WHERE conversation_id = %s ORDER BY date",
+                    (conversation_id,))
         messages = []
-        for msg in conv.messages:
+        for msg in cur.fetchall():
             messages.append({
-                'author': msg.author.name if msg.author else '[deleted]',
-                'body': msg.body_markdown,
-                'date': datetime.fromisoformat(msg.date.replace('Z', '+00:00')).strftime('%Y-%m-%d %H:%M'),
-                'is_internal': msg.is_internal
+                'author': msg[0] or '[deleted]',
+                'body': msg[1],
+                'date': datetime.fromtimestamp(msg[2]).strftime('%Y-%m-%d %H:%M') if msg[2] else '',
+                'is_internal': msg[3]
             })
             
-        return render_template('modmail_conversation.html', conversation=conv, messages=messages, user=session.get('user'))
+        return render_template('modmail_conversation.html', conversation=conversation, messages=messages, user=session.get('user'))
     except Exception as e:
         return f"Error fetching conversation: {e}", 500
+    finally:
+        cur.close()
+        conn.close()
 
 @app.route('/modmail/reply', methods=['POST'])
+@reddit_bound
 def modmail_reply():
     if not session.get('user'):
         return redirect(url_for('login'))
@@ -377,99 +592,217 @@ def modmail_reply():
     body = request.form.get('body')
     is_internal = request.form.get('is_internal') == 'on'
     
-    bot = get_bot_reddit()
-    conv = bot.subreddit(SUBREDDIT_NAME).modmail(conversation_id)
-    conv.reply(body, internal=is_internal)
-    
+    try:
+        bot = get_bot_reddit()
+        conv = bot.subreddit(SUBREDDIT_NAMES[0]).modmail(conversation_id)
+        message = conv.reply(body=body, internal=is_internal)
+
+        # Write through to the mirror so the reply shows up before the next sync
+        conn = get_db_connection()
+        modmail_sync.store_reply(conn, conversation_id, message)
+        conn.close()
+    except RateBudgetExceeded:
+        raise
+    except Exception as e:
+        return f"Error sending reply: {e}", 500
+
     return redirect(url_for('modmail_conversation', conversation_id=conversation_id))
 
 @app.route('/modmail/archive/<conversation_id>', methods=['POST'])
+@reddit_bound
 def modmail_archive(conversation_id):
     if not session.get('user'):
         return redirect(url_for('login'))
     
-    bot = get_bot_reddit()
-    conv = bot.subreddit(SUBREDDIT_NAME).modmail(conversation_id)
-    conv.archive()
+    try:
+        bot = get_bot_reddit()
+        conv = bot.subreddit(SUBREDDIT_NAMES[0]).modmail(conversation_id)
+        conv.archive()
+
+        conn = get_db_connection()
+        modmail_sync.set_state(conn, conversation_id, modmail_sync.STATE_ARCHIVED)
+        conn.close()
+    except RateBudgetExceeded:
+        raise
+    except Exception as e:
+        return f"Error archiving conversation: {e}", 500
     
     return redirect(request.referrer or url_for('modmail'))
 
 @app.route('/modmail/unarchive/<conversation_id>', methods=['POST'])
+@reddit_bound
 def modmail_unarchive(conversation_id):
     if not session.get('user'):
         return redirect(url_for('login'))
     
-    bot = get_bot_reddit()
-    conv = bot.subreddit(SUBREDDIT_NAME).modmail(conversation_id)
-    conv.unarchive()
+    try:
+        bot = get_bot_reddit()
+        conv = bot.subreddit(SUBREDDIT_NAMES[0]).modmail(conversation_id)
+        conv.unarchive()
+
+        # Reddit moves unarchived conversations to In Progress
+        conn = get_db_connection()
+        modmail_sync.set_state(conn, conversation_id, modmail_sync.STATE_IN_PROGRESS)
+        conn.close()
+    except RateBudgetExceeded:
+        raise
+    except Exception as e:
+        return f"Error unarchiving conversation: {e}", 500
     
     return redirect(request.referrer or url_for('modmail'))
 
+CONFIG_CHANNEL = 'config_changed'
+CONFIG_FILES = {
+    'automod': 'automod.yaml',
+    'tiers': 'tiers.yaml'
+}
+
+def get_config_version(cur, name, version_id=None, sub=''):
+    """Returns (id, content, subreddit) for a config version, or the latest one for a subreddit if no id is given."""
+    if version_id:
+        cur.execute("SELECT id, content, subreddit FROM config_versions WHERE name = %s AND id = %s", (name, version_id))
+    else:
+        cur.execute("SELECT id, content, subreddit FROM config_versions WHERE name = %s AND subreddit = %s ORDER BY id DESC LIMIT 1", (name, sub))
+    return cur.fetchone()
+
+def publish_config_version(conn, name, content, moderator, restored_from=None, sub=''):
+    """Stores a new config version and notifies the bot to swap it in."""
+    cur = conn.cursor()
+    cur.execute("INSERT INTO config_versions (name, content, timestamp, moderator, restored_from, subreddit) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id",
+                (name, content, datetime.now().timestamp(), moderator, restored_from, sub))
+    version_id = cur.fetchone()[0]
+    cur.execute("SELECT pg_notify(%s, %s)", (CONFIG_CHANNEL, f"{name}:{version_id}"))
+    conn.commit()
+    cur.close()
+    return version_id
+
 @app.route('/config', methods=['GET', 'POST'])
 def config():
     if not session.get('user'):
         return redirect(url_for('login'))
 
     file_type = request.args.get('file', 'automod')
-    allowed_files = {
-        'automod': 'automod.yaml',
-        'tiers': 'tiers.yaml'
-    }
-    if file_type not in allowed_files:
+    if file_type not in CONFIG_FILES:
         return "Invalid file type", 400
-    config_path = allowed_files[file_type]
+    # '' edits the default shared by every subreddit; a name edits that subreddit's override
+    sub = get_subreddit_filter()
+
+    conn = get_db_connection()
+    cur = conn.cursor()
 
     if request.method == 'POST':
         new_content = request.form.get('content')
         try:
             # Validate YAML
             yaml.safe_load(new_content)
-            
-            # Create backup
-            if os.path.exists(config_path):
-                shutil.copy(config_path, config_path + '.bak')
-            
-            # Save file
-            with open(config_path, 'w') as f:
-                f.write(new_content)
-            
-            return redirect(url_for('config', file=file_type))
+
+            # Skip no-op saves so history only holds real changes
+            latest = get_config_version(cur, file_type, sub=sub)
+            if not latest or latest[1] != new_content:
+                publish_config_version(conn, file_type, new_content, session.get('user'), sub=sub)
+
+            return redirect(url_for('config', file=file_type, sub=sub))
         except yaml.YAMLError as e:
             return f"Invalid YAML format: {e}", 400
         except Exception as e:
             return f"Error saving config: {e}", 500
+        finally:
+            cur.close()
+            conn.close()
 
-    try:
-        with open(config_path, 'r') as f:
-            content = f.read()
-    except FileNotFoundError:
-        content = f"# {config_path} not found"
-        
-    backup_exists = os.path.exists(config_path + '.bak')
-    return render_template('config.html', content=content, user=session.get('user'), backup_exists=backup_exists, current_file=file_type)
+    latest = get_config_version(cur, file_type, sub=sub)
+    inherits_default = False
+    if not latest and sub:
+        # No override yet; start from the default so saving creates one
+        latest = get_config_version(cur, file_type)
+        inherits_default = True
+    if latest:
+        current_version, content = latest[0], latest[1]
+    else:
+        # Nothing published yet; show the bundled file the bot will seed from
+        current_version = None
+        try:
+            with open(CONFIG_FILES[file_type], 'r') as f:
+                content = f.read()
+        except FileNotFoundError:
+            content = f"# {CONFIG_FILES[file_type]} not found"
+
+    cur.execute("SELECT id, timestamp, moderator, restored_from FROM config_versions WHERE name = %s AND subreddit = %s ORDER BY id DESC LIMIT 50", (file_type, sub))
+    history = []
+    for v in cur.fetchall():
+        history.append({
+            'id': v[0],
+            'time': datetime.fromtimestamp(v[1]).strftime('%Y-%m-%d %H:%M:%S'),
+            'moderator': v[2],
+            'restored_from': v[3]
+        })
+    cur.close()
+    conn.close()
+
+    return render_template('config.html', content=content, user=session.get('user'), current_file=file_type,
+                           current_version=current_version, history=history, inherits_default=inherits_default,
+                           subreddits=SUBREDDIT_NAMES, current_sub=sub)
+
+@app.route('/config/diff')
+def config_diff():
+    if not session.get('user'):
+        return redirect(url_for('login'))
+
+    file_type = request.args.get('file', 'automod')
+    version_id = request.args.get('version', type=int)
+    if file_type not in CONFIG_FILES or not version_id:
+        return "Invalid diff request", 400
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    version = get_config_version(cur, file_type, version_id)
+    if not version:
+        cur.close()
+        conn.close()
+        return "Version not found", 404
+
+    # Compare against the version before it unless another one is requested
+    against_id = request.args.get('against', type=int)
+    if against_id:
+        previous = get_config_version(cur, file_type, against_id)
+    else:
+        cur.execute("SELECT id, content FROM config_versions WHERE name = %s AND subreddit = %s AND id < %s ORDER BY id DESC LIMIT 1",
+                    (file_type, version[2], version_id))
+        previous = cur.fetchone()
+    cur.close()
+    conn.close()
+
+    previous_label = f"v{previous[0]}" if previous else "(empty)"
+    diff = difflib.unified_diff((previous[1] if previous else '').splitlines(keepends=True),
+                                version[1].splitlines(keepends=True),
+                                fromfile=previous_label, tofile=f"v{version[0]}")
+    return Response(''.join(diff) or "No differences.\n", mimetype='text/plain')
 
 @app.route('/restore_config', methods=['POST'])
 def restore_config():
     if not session.get('user'):
         return redirect(url_for('login'))
-    
+
     file_type = request.args.get('file', 'automod')
-    allowed_files = {
-        'automod': 'automod.yaml',
-        'tiers': 'tiers.yaml'
-    }
-    if file_type not in allowed_files:
+    version_id = request.form.get('version', type=int)
+    if file_type not in CONFIG_FILES or not version_id:
         return "Invalid file type", 400
-    config_path = allowed_files[file_type]
-    backup_path = config_path + '.bak'
-    
-    if os.path.exists(backup_path):
-        try:
-            shutil.copy(backup_path, config_path)
-        except Exception as e:
-            return f"Error restoring config: {e}", 500
-            
-    return redirect(url_for('config', file=file_type))
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        version = get_config_version(cur, file_type, version_id)
+        if not version:
+            return "Version not found", 404
+        # Rolling back publishes the old content as a new version so history stays linear
+        publish_config_version(conn, file_type, version[1], session.get('user'), restored_from=version_id, sub=version[2])
+    except Exception as e:
+        return f"Error restoring config: {e}", 500
+    finally:
+        cur.close()
+        conn.close()
+
+    return redirect(url_for('config', file=file_type, sub=version[2]))
 
 @app.route('/export_csv')
 def export_csv():
@@ -477,15 +810,14 @@ def export_csv():
         return redirect(url_for('login'))
     
     search_query = request.args.get('search', '').strip()
+    order = request.args.get('order', 'time')
+    sub = get_subreddit_filter()
     
     conn = get_db_connection()
     cur = conn.cursor()
     
-    if search_query:
-        search_pattern = f"%{search_query}%"
-        cur.execute('SELECT * FROM mod_actions WHERE username ILIKE %s OR action_type ILIKE %s ORDER BY timestamp DESC', (search_pattern, search_pattern))
-    else:
-        cur.execute('SELECT * FROM mod_actions ORDER BY timestamp DESC')
+    where, params, order_by, order_params = build_action_filters(search_query, sub, order)
+    cur.execute(f'SELECT {ACTION_COLUMNS} FROM mod_actions {where} ORDER BY {order_by}', params + order_params)
     
     actions = cur.fetchall()
     cur.close()
@@ -496,119 +828,168 @@ def export_csv():
         w = csv.writer(data)
         
         # Write header
-        w.writerow(('ID', 'Action Type', 'Username', 'Details', 'Time', 'Submission ID', 'Can Approve'))
+        w.writerow(('ID', 'Action Type', 'Username', 'Details', 'Time', 'Submission ID', 'Can Approve', 'Subreddit'))
         yield data.getvalue()
         data.seek(0)
         data.truncate(0)
         
         for a in actions:
             dt = datetime.fromtimestamp(a[4]).strftime('%Y-%m-%d %H:%M:%S')
-            # Schema: id, action_type, username, details, timestamp, submission_id, can_approve
-            w.writerow((a[0], a[1], a[2], a[3], dt, a[5] if len(a) > 5 else '', a[6] if len(a) > 6 else True))
+            # Schema: id, action_type, username, details, timestamp, submission_id, can_approve, subreddit
+            w.writerow((a[0], a[1], a[2], a[3], dt, a[5] if len(a) > 5 else '', a[6] if len(a) > 6 else True, a[7] if len(a) > 7 else ''))
             yield data.getvalue()
             data.seek(0)
             data.truncate(0)
 
     return Response(generate(), mimetype='text/csv', headers={"Content-Disposition": "attachment; filename=mod_log.csv"})
 
-@app.route('/stats')
-def stats():
-    if not session.get('user'):
-        return redirect(url_for('login'))
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Date filtering
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+def load_stats(cur, start_date, end_date, sub, today):
+    # Subreddit filtering (TRUE keeps the queries valid when showing all subreddits)
+    sub_filter = 'subreddit = %s' if sub else 'TRUE'
+    sub_params = (sub,) if sub else ()
 
     if start_date and end_date:
-        # Filtered Stats
-        cur.execute('''
+        # Filtered Stats (bounds are compared on the raw timestamp so partitions outside the range are pruned)
+        cur.execute(f'''
             SELECT action_type, COUNT(*) FROM mod_actions 
-            WHERE to_timestamp(timestamp) >= %s::date AND to_timestamp(timestamp) < %s::date + interval '1 day'
+            WHERE {sub_filter} AND timestamp >= extract(epoch from %s::date::timestamptz) AND timestamp < extract(epoch from (%s::date + 1)::timestamptz)
             GROUP BY action_type ORDER BY COUNT(*) DESC
-        ''', (start_date, end_date))
+        ''', sub_params + (start_date, end_date))
         type_data = cur.fetchall()
 
-        cur.execute('''
+        cur.execute(f'''
             SELECT to_char(to_timestamp(timestamp), 'YYYY-MM-DD') as day, COUNT(*) 
             FROM mod_actions 
-            WHERE to_timestamp(timestamp) >= %s::date AND to_timestamp(timestamp) < %s::date + interval '1 day'
+            WHERE {sub_filter} AND timestamp >= extract(epoch from %s::date::timestamptz) AND timestamp < extract(epoch from (%s::date + 1)::timestamptz)
             GROUP BY day 
             ORDER BY day ASC
-        ''', (start_date, end_date))
+        ''', sub_params + (start_date, end_date))
         time_data = cur.fetchall()
 
-        cur.execute('''
+        cur.execute(f'''
             SELECT username, COUNT(*) FROM mod_actions 
-            WHERE to_timestamp(timestamp) >= %s::date AND to_timestamp(timestamp) < %s::date + interval '1 day'
+            WHERE {sub_filter} AND timestamp >= extract(epoch from %s::date::timestamptz) AND timestamp < extract(epoch from (%s::date + 1)::timestamptz)
             GROUP BY username ORDER BY COUNT(*) DESC LIMIT 10
-        ''', (start_date, end_date))
+        ''', sub_params + (start_date, end_date))
         top_offenders = cur.fetchall()
     else:
-        # Default Stats (All time for types, last 30 days for time)
-        cur.execute('SELECT action_type, COUNT(*) FROM mod_actions GROUP BY action_type ORDER BY COUNT(*) DESC')
+        # Default Stats (All time for types, last 30 days for time). The window is whole days ending
+        # with `today`, so the result only changes with the data or the date (the cache key)
+        cur.execute(f'SELECT action_type, COUNT(*) FROM mod_actions WHERE {sub_filter} GROUP BY action_type ORDER BY COUNT(*) DESC', sub_params)
         type_data = cur.fetchall()
         
-        cur.execute('''
+        cur.execute(f'''
             SELECT to_char(to_timestamp(timestamp), 'YYYY-MM-DD') as day, COUNT(*) 
             FROM mod_actions 
-            WHERE timestamp > extract(epoch from now()) - 2592000 
+            WHERE {sub_filter} AND timestamp >= extract(epoch from (%s::date - 29)::timestamptz)
             GROUP BY day 
             ORDER BY day ASC
-        ''')
+        ''', sub_params + (today,))
         time_data = cur.fetchall()
 
-        cur.execute('SELECT username, COUNT(*) FROM mod_actions GROUP BY username ORDER BY COUNT(*) DESC LIMIT 10')
+        # All-time totals come straight from the maintained summary ('' is the all-subreddit row)
+        cur.execute('SELECT username, total_actions FROM user_summary WHERE subreddit = %s ORDER BY total_actions DESC LIMIT 10', (sub,))
         top_offenders = cur.fetchall()
+
+    return {
+        'type_labels': [row[0] for row in type_data],
+        'type_values': [row[1] for row in type_data],
+        'time_labels': [row[0] for row in time_data],
+        'time_values': [row[1] for row in time_data],
+        'top_offenders': top_offenders
+    }
+
+@app.route('/stats')
+def stats():
+    if not session.get('user'):
+        return redirect(url_for('login'))
     
+    # Date filtering
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    sub = get_subreddit_filter()
+
+    # The default view charts the 30 days up to today, so it also has to roll over when the date changes
+    today = datetime.now(timezone.utc).date().isoformat()
+    key_suffix = '' if start_date and end_date else f"#{today}"
+
+    return cached_view(lambda cur: load_stats(cur, start_date, end_date, sub, today),
+                       lambda result: render_template('stats.html',
+                                                      user=session.get('user'),
+                                                      start_date=start_date,
+                                                      end_date=end_date,
+                                                      subreddits=SUBREDDIT_NAMES,
+                                                      current_sub=sub,
+                                                      **result),
+                       key_suffix)
+
+@app.route('/user/<username>')
+def user_profile(username):
+    if not session.get('user'):
+        return redirect(url_for('login'))
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''SELECT subreddit, username, action_counts, total_actions, first_seen, last_seen, note, note_moderator, note_timestamp
+                   FROM user_summary WHERE username_key = %s ORDER BY subreddit''', (username.lower(),))
+    rows = cur.fetchall()
     cur.close()
     conn.close()
-    
-    return render_template('stats.html', 
-                           type_labels=[row[0] for row in type_data], 
-                           type_values=[row[1] for row in type_data],
-                           time_labels=[row[0] for row in time_data],
-                           time_values=[row[1] for row in time_data],
-                           user=session.get('user'),
-                           start_date=start_date,
-                           end_date=end_date,
-                           top_offenders=top_offenders)
+
+    def fmt(ts):
+        return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M') if ts else None
+
+    summary = None
+    per_subreddit = []
+    for row in rows:
+        entry = {
+            'subreddit': row[0],
+            'counts': sorted(row[2].items(), key=lambda kv: kv[1], reverse=True),
+            'total': row[3],
+            'first_seen': fmt(row[4]),
+            'last_seen': fmt(row[5])
+        }
+        if row[0] == '':
+            # Schema: the '' row covers every subreddit and carries the user's note
+            username = row[1] or username
+            entry.update({'note': row[6], 'note_moderator': row[7], 'note_time': fmt(row[8])})
+            summary = entry
+        else:
+            per_subreddit.append(entry)
+
+    return render_template('user.html', username=username, summary=summary, per_subreddit=per_subreddit,
+                           user=session.get('user'))
 
 @app.route('/api/recent_actions')
 def api_recent_actions():
     if not session.get('user'):
         return jsonify({"error": "Unauthorized"}), 401
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM mod_actions ORDER BY timestamp DESC LIMIT 5')
-    actions = cur.fetchall()
-    cur.close()
-    conn.close()
+    where, params, _, _ = build_action_filters(sub=get_subreddit_filter())
 
-    formatted_actions = []
-    for a in actions:
-        dt = datetime.fromtimestamp(a[4]).strftime('%H:%M:%S')
-        formatted_actions.append({
-            'type': a[1],
-            'user': a[2],
-            'details': a[3],
-            'time': dt
-        })
-    return jsonify(formatted_actions)
+    def load(cur):
+        cur.execute(f'SELECT {ACTION_COLUMNS} FROM mod_actions {where} ORDER BY timestamp DESC LIMIT 5', params)
+        formatted_actions = []
+        for a in cur.fetchall():
+            dt = datetime.fromtimestamp(a[4]).strftime('%H:%M:%S')
+            formatted_actions.append({
+                'type': a[1],
+                'user': a[2],
+                'details': a[3],
+                'time': dt
+            })
+        return formatted_actions
+
+    return cached_view(load, jsonify)
 
 @app.route('/notes', methods=['GET', 'POST'])
 def notes():
     if not session.get('user'):
         return redirect(url_for('login'))
     
-    conn = get_db_connection()
-    cur = conn.cursor()
-
     if request.method == 'POST':
+        conn = get_db_connection()
+        cur = conn.cursor()
         action = request.form.get('action')
         username = request.form.get('username').strip()
         
@@ -629,73 +1010,68 @@ def notes():
         elif action == 'delete':
             cur.execute('DELETE FROM user_notes WHERE username = %s', (username,))
             conn.commit()
-            
+
+        cur.close()
+        conn.close()
         return redirect(url_for('notes'))
 
-    cur.execute('SELECT * FROM user_notes ORDER BY timestamp DESC')
-    notes_data = cur.fetchall()
-    cur.close()
-    conn.close()
-    
-    formatted_notes = []
-    for n in notes_data:
-        # Schema: username, note, timestamp, moderator
-        dt = datetime.fromtimestamp(n[2]).strftime('%Y-%m-%d %H:%M')
-        formatted_notes.append({
-            'username': n[0],
-            'note': n[1],
-            'time': dt,
-            'moderator': n[3]
-        })
+    def load(cur):
+        cur.execute('SELECT username, note, timestamp, moderator FROM user_notes ORDER BY timestamp DESC')
+        formatted_notes = []
+        for n in cur.fetchall():
+            # Schema: username, note, timestamp, moderator
+            dt = datetime.fromtimestamp(n[2]).strftime('%Y-%m-%d %H:%M')
+            formatted_notes.append({
+                'username': n[0],
+                'note': n[1],
+                'time': dt,
+                'moderator': n[3]
+            })
+        return formatted_notes
 
-    return render_template('notes.html', notes=formatted_notes, user=session.get('user'))
+    return cached_view(load, lambda formatted_notes: render_template('notes.html', notes=formatted_notes, user=session.get('user')))
 
 @app.route('/')
 def index():
     user = session.get('user')
     page = request.args.get('page', 1, type=int)
     search_query = request.args.get('search', '').strip()
+    order = request.args.get('order', 'time')
+    sub = get_subreddit_filter()
 
     if page < 1:
         page = 1
     per_page = 50
     offset = (page - 1) * per_page
 
-    conn = get_db_connection()
-    cur = conn.cursor()
+    where, params, order_by, order_params = build_action_filters(search_query, sub, order)
 
-    if search_query:
-        search_pattern = f"%{search_query}%"
-        cur.execute('SELECT COUNT(*) FROM mod_actions WHERE username ILIKE %s OR action_type ILIKE %s', (search_pattern, search_pattern))
-        total_count = cur.fetchone()[0]
-        cur.execute('SELECT * FROM mod_actions WHERE username ILIKE %s OR action_type ILIKE %s ORDER BY timestamp DESC LIMIT %s OFFSET %s', (search_pattern, search_pattern, per_page, offset))
-    else:
-        cur.execute('SELECT COUNT(*) FROM mod_actions')
+    def load(cur):
+        cur.execute(f'SELECT COUNT(*) FROM mod_actions {where}', params)
         total_count = cur.fetchone()[0]
-        cur.execute('SELECT * FROM mod_actions ORDER BY timestamp DESC LIMIT %s OFFSET %s', (per_page, offset))
+        cur.execute(f'SELECT {ACTION_COLUMNS} FROM mod_actions {where} ORDER BY {order_by} LIMIT %s OFFSET %s', params + order_params + [per_page, offset])
 
-    actions = cur.fetchall()
-    cur.close()
-    conn.close()
+        formatted_actions = []
+        for a in cur.fetchall():
+            # Schema: id, action_type, username, details, timestamp, submission_id, can_approve, subreddit
+            dt = datetime.fromtimestamp(a[4]).strftime('%Y-%m-%d %H:%M:%S')
+            formatted_actions.append({
+                'type': a[1],
+                'user': a[2],
+                'details': a[3],
+                'time': dt,
+                'submission_id': a[5] if len(a) > 5 else None,
+                'can_approve': a[6] if len(a) > 6 else True,
+                'subreddit': a[7] if len(a) > 7 else None
+            })
 
-    formatted_actions = []
-    for a in actions:
-        # Schema: id, action_type, username, details, timestamp, submission_id, can_approve
-        dt = datetime.fromtimestamp(a[4]).strftime('%Y-%m-%d %H:%M:%S')
-        formatted_actions.append({
-            'type': a[1],
-            'user': a[2],
-            'details': a[3],
-            'time': dt,
-            'submission_id': a[5] if len(a) > 5 else None,
-            'can_approve': a[6] if len(a) > 6 else True
-        })
-    
-    total_pages = (total_count + per_page - 1) // per_page
-    if total_pages == 0:
-        total_pages = 1
-    
-    return render_template('index.html', actions=formatted_actions, user=user, page=page, total_pages=total_pages, search=search_query, test_mode=TEST_MODE)
+        total_pages = (total_count + per_page - 1) // per_page
+        if total_pages == 0:
+            total_pages = 1
+        return {'actions': formatted_actions, 'total_pages': total_pages}
+
+    return cached_view(load, lambda result: render_template('index.html', user=user, page=page, search=search_query, test_mode=TEST_MODE,
+                                                            subreddits=SUBREDDIT_NAMES, current_sub=sub, order=order, **result))
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file